@@ -1,13 +1,233 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QInputDialog, QLineEdit, QFileDialog,qApp, QDialog, QFormLayout, QLabel, QPushButton,QVBoxLayout, QListView,QMessageBox
+from PyQt5.QtWidgets import QApplication, QWidget, QInputDialog, QLineEdit, QFileDialog,qApp, QDialog, QFormLayout, QLabel, QPushButton,QVBoxLayout, QListView,QMessageBox, QProgressBar
 from PyQt5.QtGui import QIcon, QStandardItem,QStandardItemModel
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
 import os
+import queue
+import multiprocessing
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 sys.path.append("/Users/cassberk/code/")
 import XPyS.avg
 import glob
 import h5py
+import numpy as np
+import experiment_index
 from IPython import embed as shell
 
+
+def parse_avg(avgfile, sample_name, experiment_name):
+    """Parse a single .avg file, run in a worker process.
+
+    XPyS.avg does the parsing into a scratch hdf5 file which is read back into
+    plain arrays, so nothing but numpy crosses back to the writer.
+    Returns {'root': attrs, 'groups': {path: attrs}, 'datasets': {path: (data, attrs)}}
+    """
+    parsed = {'root':{}, 'groups':{'':{}}, 'datasets':{}}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmppath = os.path.join(tmp, 'parsed.hdf5')
+        XPyS.avg.avg_to_hdf5(sample_name = sample_name,experiment_name = experiment_name,avgfiles = [avgfile],savepath = tmppath,force = False)
+        with h5py.File(tmppath,'r') as f:
+            parsed['root'] = dict(f.attrs)
+            parsed['groups'][''] = dict(f[experiment_name].attrs)
+            def collect(name, obj):
+                if isinstance(obj, h5py.Dataset):
+                    parsed['datasets'][name] = (obj[()], dict(obj.attrs))
+                else:
+                    parsed['groups'][name] = dict(obj.attrs)
+            f[experiment_name].visititems(collect)
+    return parsed
+
+
+def _merge_attrs(target, attrs):
+    for key, value in attrs.items():
+        if key not in target.attrs:
+            target.attrs[key] = value
+        elif isinstance(value, np.ndarray) and (value.ndim == 1) and (value.dtype.kind in ('S','O','U')):
+            # Lists of scans are unioned, keeping the order they were first seen in
+            current = list(target.attrs[key])
+            target.attrs[key] = current + [v for v in value if v not in current]
+
+
+# Energy axes, written once and the same for every file of a scan
+AXES = ['E']
+
+
+def _is_axis(path):
+    return path.split('/')[-1] in AXES
+
+
+def _storable(data):
+    """data with strings as objects, which h5py stores as variable length strings"""
+    return data.astype(object) if data.dtype.kind in ('O','U') else data
+
+
+def _dtype(data):
+    return h5py.string_dtype() if data.dtype.kind in ('O','U') else data.dtype
+
+
+class ExperimentWriter:
+    """Appends parsed files to one experiment, one file at a time.
+
+    Every file adds to the first axis of each dataset: 1D data (I of a single
+    spectrum, per spectrum metadata) becomes a row, a scalar one element, 2D
+    and up keep their rows. Axes like E are written once and every later file
+    has to have the same.
+
+    The rows are appended as they come to resizable datasets in a scratch file,
+    so only one parsed file is held in memory. write() copies them into the
+    experiment as contiguous datasets, which can be memory mapped when lazy
+    loading, a block of rows at a time.
+    """
+    BLOCK_ROWS = 1024
+
+    def __init__(self, experiment, scratch):
+        self.experiment = experiment
+        self.scratch = scratch
+        self.attrs = {}
+
+    def row_shape(self, path):
+        if path in self.scratch:
+            return self.scratch[path].shape[1:]
+        if path in self.experiment:
+            return self.experiment[path].shape[1:]
+        return None
+
+    def add(self, parsed):
+        """Append one parsed file. Raises ValueError, having written nothing, if it doesn't fit the earlier ones."""
+        datasets = {}
+        for path, (data, attrs) in parsed['datasets'].items():
+            data = np.asarray(data)
+            if _is_axis(path):
+                first = self.experiment[path][()] if path in self.experiment else None
+                if (first is not None) and ((first.shape != data.shape) or not np.allclose(first, data)):
+                    raise ValueError('%s is not the same as in the first file' % path)
+            else:
+                data = data.reshape((1,) + data.shape) if data.ndim < 2 else data
+                row_shape = self.row_shape(path)
+                if (row_shape is not None) and (row_shape != data.shape[1:]):
+                    raise ValueError('%s has shape %s, earlier files %s' % (path, data.shape[1:], row_shape))
+            datasets[path] = (data, attrs)
+
+        _merge_attrs(self.experiment.file, parsed['root'])
+        for path in sorted(parsed['groups'].keys()):
+            grp = self.experiment.require_group(path) if path else self.experiment
+            _merge_attrs(grp, parsed['groups'][path])
+        for path, (data, attrs) in datasets.items():
+            self.attrs.setdefault(path, []).append(attrs)
+            if _is_axis(path):
+                if path not in self.experiment:
+                    self.experiment.create_dataset(path, data = _storable(data), dtype = _dtype(data))
+                continue
+            if path not in self.scratch:
+                ds = self.scratch.create_dataset(path, shape = (0,) + data.shape[1:], dtype = _dtype(data), \
+                    maxshape = (None,) + data.shape[1:], chunks = True)
+                if path in self.experiment:
+                    # Left by an earlier conversion into the same experiment, kept in front
+                    self.append(ds, self.experiment[path][()])
+            self.append(self.scratch[path], data)
+
+    def append(self, ds, data):
+        n = ds.shape[0]
+        ds.resize(n + data.shape[0], axis = 0)
+        ds[n:] = _storable(data)
+
+    def write(self):
+        def copy(path, src):
+            if not isinstance(src, h5py.Dataset):
+                return
+            if path in self.experiment:
+                del self.experiment[path]
+            ds = self.experiment.create_dataset(path, shape = src.shape, dtype = src.dtype)
+            for start in range(0, src.shape[0], self.BLOCK_ROWS):
+                ds[start:start+self.BLOCK_ROWS] = src[start:start+self.BLOCK_ROWS]
+        self.scratch.visititems(copy)
+        for path, attrs_list in self.attrs.items():
+            for attrs in attrs_list:
+                _merge_attrs(self.experiment[path], attrs)
+        self.attrs = {}
+
+
+class ConvertWorker(QObject):
+    """Converts .avg files to hdf5 off the GUI thread.
+
+    Files are parsed in a process pool and the parsed arrays are passed through a
+    queue to a single writer thread which owns the hdf5 file. It checks and
+    appends them in the order the files were chosen (ExperimentWriter) and
+    copies them into the experiment group once the last one is in.
+    """
+    progress = pyqtSignal(int,int)
+    fileFailed = pyqtSignal(str,str)
+    finished = pyqtSignal()
+
+    def __init__(self, sample_name, experiment_name, avgfiles, savepath, overwrite = False, max_workers = None):
+        super().__init__()
+        self.sample_name = sample_name
+        self.experiment_name = experiment_name
+        self.avgfiles = avgfiles
+        self.savepath = savepath
+        self.overwrite = overwrite
+        self.max_workers = max_workers
+        self.queue = queue.Queue()
+
+    def write_loop(self):
+        try:
+            self._write_loop()
+        except Exception:
+            self.fileFailed.emit(self.savepath,traceback.format_exc())
+            # Keep draining so the parsing side never blocks on a dead writer
+            while self.queue.get()[0] is not None:
+                pass
+
+    def _write_loop(self):
+        pending = {}
+        next_file = 0
+        written = 0
+        with h5py.File(self.savepath,'a') as f, tempfile.TemporaryDirectory() as tmp, \
+            h5py.File(os.path.join(tmp,'rows.hdf5'),'w') as scratch:
+            if self.overwrite and (self.experiment_name in f):
+                del f[self.experiment_name]
+            writer = ExperimentWriter(f.require_group(self.experiment_name), scratch)
+            while next_file < len(self.avgfiles):
+                n, parsed = self.queue.get()
+                if n is None:
+                    break
+                pending[n] = parsed
+                # Results arrive out of order, hold them until their turn
+                while next_file in pending:
+                    parsed = pending.pop(next_file)
+                    if parsed is not None:
+                        try:
+                            writer.add(parsed)
+                        except Exception:
+                            self.fileFailed.emit(self.avgfiles[next_file],traceback.format_exc())
+                    next_file += 1
+                    written += 1
+                    self.progress.emit(written,len(self.avgfiles))
+            writer.write()
+
+    def run(self):
+        writer = threading.Thread(target = self.write_loop)
+        writer.start()
+        try:
+            # Spawned, not forked, so no child inherits h5py's lock from the writer thread
+            with ProcessPoolExecutor(max_workers = self.max_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(parse_avg, avgfile, self.sample_name, self.experiment_name): n \
+                    for n, avgfile in enumerate(self.avgfiles)}
+                for future in as_completed(futures):
+                    n = futures[future]
+                    try:
+                        self.queue.put((n, future.result()))
+                    except Exception as e:
+                        self.fileFailed.emit(self.avgfiles[n],str(e))
+                        self.queue.put((n, None))
+        finally:
+            self.queue.put((None, None))
+            writer.join()
+        self.finished.emit()
+
 class MessageWindow(QWidget):
     """
     This "window" is a QWidget. If it has no parent, it
@@ -68,6 +288,10 @@ class App(QWidget):
         self.convertButton.setText("Convert")
         self.convertButton.clicked.connect(self.convert)
 
+        self.progress = QProgressBar()
+        self.progress.setMinimum(0)
+        self.progress.setValue(0)
+
         self.clearButton = QPushButton()
         self.clearButton.setText("clear")
         self.clearButton.clicked.connect(self.clearList)
@@ -93,6 +317,7 @@ class App(QWidget):
         layout.addWidget(self.listView)
         layout.addWidget(self.clearButton)
         layout.addWidget(self.convertButton)
+        layout.addWidget(self.progress)
         self.setLayout(layout)
 
         self.show()
@@ -153,20 +378,52 @@ class App(QWidget):
             else:
                 svpth = self.savepath.text()
 
-            with h5py.File(svpth,'a') as f:
-                current_groups = [grp for grp in f.keys()]
+            current_groups = experiment_index.default_index().experiments(svpth)
             if any([self.experimentname.text() in group for group in current_groups]):
                 choice = QMessageBox.question(self, 'Experiment already present',
                                                 "Experiment already present. \n Do you want to overwrite?",
                                                 QMessageBox.Yes | QMessageBox.No)
                 if choice == QMessageBox.Yes:
                     print("overwriting")
-                    XPyS.avg.avg_to_hdf5(sample_name = self.samplename.text(),experiment_name = self.experimentname.text(),avgfiles = self.files,savepath = svpth,force = False)
+                    self.start_conversion(svpth, overwrite = True)
                 else:
                     pass
             else:
                 # shell()
-                XPyS.avg.avg_to_hdf5(sample_name = self.samplename.text(),experiment_name = self.experimentname.text(),avgfiles = self.files,savepath = svpth,force = False)
+                self.start_conversion(svpth)
+
+    def start_conversion(self, svpth, overwrite = False):
+        self.failed_files = []
+        self.convertButton.setEnabled(False)
+        self.progress.setMaximum(len(self.files))
+        self.progress.setValue(0)
+
+        self.convert_worker = ConvertWorker(sample_name = self.samplename.text(),experiment_name = self.experimentname.text(), \
+            avgfiles = list(self.files),savepath = svpth,overwrite = overwrite)
+        self.convert_thread = QThread(self)
+        self.convert_worker.moveToThread(self.convert_thread)
+
+        self.convert_thread.started.connect(self.convert_worker.run)
+        self.convert_worker.progress.connect(self.update_progress)
+        self.convert_worker.fileFailed.connect(self.file_failed)
+        self.convert_worker.finished.connect(self.convert_thread.quit)
+        self.convert_thread.finished.connect(self.conversion_finished)
+        self.convert_thread.start()
+
+    def update_progress(self, n, total):
+        self.progress.setValue(n)
+
+    def file_failed(self, avgfile, error):
+        print('Failed to convert',avgfile,':',error)
+        self.failed_files.append(avgfile)
+
+    def conversion_finished(self):
+        self.convert_thread.deleteLater()
+        self.convert_worker.deleteLater()
+        self.convertButton.setEnabled(True)
+        if self.failed_files != []:
+            self.error = MessageWindow(message = 'These files could not be converted:\n' + '\n'.join(self.failed_files))
+            self.error.show()
                
 
 if __name__ == '__main__':
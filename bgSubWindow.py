@@ -17,11 +17,14 @@ sys.path.append("/Users/cassberk/code")
 import XPyS.io
 import XPyS.sample
 from XPyS import bkgrds as bksb
+import bg_engine
+import changes
 
 import XPyS.saved_models.Nb3d.nb_oxide_analysis as nbox
 import XPyS.saved_models.Si2p.si_oxide_analysis as siox
 
 from copy import deepcopy as dc
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from parameter_gui import ParameterWindow
 from fitwindow import FitViewWindow
@@ -31,13 +34,94 @@ import data_tree
 from IPython import embed as shell
 
 
+class BGPipelineWorker(QObject):
+    """Background subtracts every orbital of the sample with its stored bg_info.
+
+    The orbitals are independent so they are spread over a thread pool, numpy
+    releases the GIL for the heavy parts. finished is emitted once at the end so
+    anything listening only redraws once.
+    """
+    orbitalDone = pyqtSignal(str)
+    orbitalFailed = pyqtSignal(str,str)
+    finished = pyqtSignal()
+
+    def __init__(self, sample, max_workers = None, batch = False):
+        super().__init__()
+        self.sample = sample
+        self.max_workers = max_workers
+        self.batch = batch
+
+    def subtract_orbital(self, orbital):
+        subpars = list(self.sample.bg_info[orbital])
+        bg_engine.run_bg_sub(self.sample.__dict__[orbital], subpars, batch = self.batch)
+        return orbital
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = {executor.submit(self.subtract_orbital, orb): orb for orb in self.sample.element_scans}
+            for future in as_completed(futures):
+                orbital = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.orbitalFailed.emit(orbital,str(e))
+                else:
+                    self.sample.bg_info[orbital] = self.sample.__dict__[orbital].bg_info
+                    changes.mark_dirty(self.sample, 'bg_info', orbital)
+                    self.orbitalDone.emit(orbital)
+        self.finished.emit()
+
+
+class OrbitalView:
+    """The orbital bgSubWindow is showing: its spectra and background settings.
+
+    Switching orbital swaps this object, the widgets stay connected as they are.
+    """
+
+    def __init__(self, sample, orbital):
+        self.orbital = orbital
+        self.spectra = sample.__dict__[orbital]
+        self.bg_info = sample.bg_info[orbital]
+        self.energy = bg_engine.energy_index(self.spectra)
+        self.Emin = self.energy.Emin
+        self.Emax = self.energy.Emax
+        self.n_spectra = len(self.spectra.I)
+
+    @property
+    def bgtype(self):
+        return self.bg_info[1]
+
+    @property
+    def limits(self):
+        return self.bg_info[0]
+
+    @property
+    def ut2(self):
+        """(B, vary B, C, vary C) or None when none are saved"""
+        return self.bg_info[2] if len(self.bg_info) > 2 else None
+
+
 class bgSubWindow(QMainWindow):
+    allSubtracted = pyqtSignal()
 
     def __init__(self,sample):
         super().__init__()
         self.sample = sample
+        self.tougaard_cache = bg_engine.TougaardCache()
+
+        # Redraws asked for while handling one user action are merged into one.
+        # The counts are shown in the status bar so extra redraws stand out.
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(0)
+        self.redraw_timer.timeout.connect(self.update_plot)
+        self.redraw_requests = 0
+        # Set while BG Subtract All replaces esub/isub/bg on the worker thread
+        self.subtracting = False
+
         self.initUI()
         self.create_main_frame()
+        self.create_status_bar()
         self.update_plot()
         self.setAttribute(Qt.WA_DeleteOnClose, True)
 
@@ -46,13 +130,14 @@ class bgSubWindow(QMainWindow):
         self.bgSpecSelect = QComboBox(self)
         self.bgSpecSelect.addItems([orb for orb in self.sample.element_scans])
         self.bgSpecSelect.currentIndexChanged.connect(self.load_bgVals)
-        self.bgSpecSelect.currentIndexChanged.connect(self.update_plot)
 
         self.bgTypeBox = QComboBox(self)
         self.bgTypeBox.addItems(['linear','shirley','UT2'])
 
         self.minBox= QDoubleSpinBox()
+        self.minBox.valueChanged.connect(self.request_redraw)
         self.maxBox= QDoubleSpinBox()
+        self.maxBox.valueChanged.connect(self.request_redraw)
 
         self.parB_Box = QDoubleSpinBox()
         self.parB_Box.setMaximum(np.inf)
@@ -60,7 +145,7 @@ class bgSubWindow(QMainWindow):
         self.parB_Box.setObjectName('B')
         self.parB_Box.editingFinished.connect(self.update_slider)
         self.parB_Box.editingFinished.connect(self.set_bgPars)
-        self.parB_Box.editingFinished.connect(self.update_plot)
+        self.parB_Box.editingFinished.connect(self.request_redraw)
 
         self.parC_Box = QDoubleSpinBox()
         self.parC_Box.setMaximum(np.inf)
@@ -68,7 +153,7 @@ class bgSubWindow(QMainWindow):
         self.parC_Box.setObjectName('C')
         self.parC_Box.editingFinished.connect(self.update_slider)
         self.parC_Box.editingFinished.connect(self.set_bgPars)
-        self.parC_Box.editingFinished.connect(self.update_plot)
+        self.parC_Box.editingFinished.connect(self.request_redraw)
 
         self.parB_cb = QCheckBox("B")
         self.parC_cb= QCheckBox("C")
@@ -89,7 +174,7 @@ class bgSubWindow(QMainWindow):
         self.Bslider.setMinimum(0)
         self.Bslider.setMaximum(3000)
         self.Bslider.valueChanged.connect(self.update_spinbox)
-        self.Bslider.valueChanged.connect(self.update_plot)
+        self.Bslider.valueChanged.connect(self.request_redraw)
 
         self.CminBox = QDoubleSpinBox()
         self.CminBox.setMaximum(3000)
@@ -106,19 +191,30 @@ class bgSubWindow(QMainWindow):
         self.Cslider.setMinimum(0)
         self.Cslider.setMaximum(3000)
         self.Cslider.valueChanged.connect(self.update_spinbox)
-        self.Cslider.valueChanged.connect(self.update_plot)
+        self.Cslider.valueChanged.connect(self.request_redraw)
 
         self.setBG_Button = QPushButton('Select', self)
         self.setBG_Button.setObjectName('setBGbutton')
         self.setBG_Button.clicked.connect(self.set_bgPars)
-        self.setBG_Button.clicked.connect(self.update_plot)
+        self.setBG_Button.clicked.connect(self.request_redraw)
 
         self.BGSubtract_Button = QPushButton('BG Subtract', self)
         self.BGSubtract_Button.setObjectName('BGSubtractButton')
         self.BGSubtract_Button.clicked.connect(self.BGSubtract)
 
+        self.BGSubtractAll_Button = QPushButton('BG Subtract All', self)
+        self.BGSubtractAll_Button.setObjectName('BGSubtractAllButton')
+        self.BGSubtractAll_Button.setToolTip('Subtract every orbital with its saved background settings')
+        self.BGSubtractAll_Button.clicked.connect(self.BGSubtractAll)
+
+        self.batch_bg_cb = QCheckBox('Batch backgrounds')
+        self.batch_bg_cb.setToolTip('Subtract and preview with the numpy backgrounds instead of XPyS, faster but\n'
+            'not yet checked against bksb for every orbital (see check_backgrounds.py)')
+        self.batch_bg_cb.setChecked(False)
+        self.batch_bg_cb.stateChanged.connect(self.request_redraw)
+
         self.spectra_plot_box = QSpinBox()
-        self.spectra_plot_box.valueChanged.connect(self.update_plot)
+        self.spectra_plot_box.valueChanged.connect(self.request_redraw)
 
         self.UT2params = lm.Parameters()
         self.UT2params.add('B',value = 355)
@@ -131,33 +227,41 @@ class bgSubWindow(QMainWindow):
 
 
     def load_bgVals(self):
-        bgtype_idx = self.bgTypeBox.findText(self.sample.bg_info[self.bgSpecSelect.currentText()][1])
-        self.bgTypeBox.setCurrentIndex(bgtype_idx)
+        """Show the orbital picked in bgSpecSelect.
+
+        The widgets were all connected once in initUI, here they are only set
+        with their signals blocked and a single redraw is asked for at the end.
+        """
+        self.view = OrbitalView(self.sample, self.bgSpecSelect.currentText())
+        widgets = [self.bgTypeBox, self.minBox, self.maxBox, self.spectra_plot_box, self.parB_Box, self.parC_Box, \
+            self.Bslider, self.Cslider, self.parB_cb, self.parC_cb]
+        for w in widgets:
+            w.blockSignals(True)
+
+        self.bgTypeBox.setCurrentIndex(self.bgTypeBox.findText(self.view.bgtype))
 
-        self.minBox.setMaximum(np.max(self.sample.__dict__[self.bgSpecSelect.currentText()].E))  # Need to set max and min before value 
-        self.minBox.setMinimum(np.min(self.sample.__dict__[self.bgSpecSelect.currentText()].E)) 
-        self.minBox.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][0][0])
-        self.minBox.valueChanged.connect(self.update_plot)
+        self.minBox.setMaximum(self.view.Emax)  # Need to set max and min before value 
+        self.minBox.setMinimum(self.view.Emin) 
+        self.minBox.setValue(self.view.limits[0])
 
-        self.maxBox.setMaximum(np.max(self.sample.__dict__[self.bgSpecSelect.currentText()].E))  # Need to set max and min before value 
-        self.maxBox.setMinimum(np.min(self.sample.__dict__[self.bgSpecSelect.currentText()].E)) 
-        self.maxBox.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][0][1])
-        self.maxBox.valueChanged.connect(self.update_plot)
+        self.maxBox.setMaximum(self.view.Emax)  # Need to set max and min before value 
+        self.maxBox.setMinimum(self.view.Emin) 
+        self.maxBox.setValue(self.view.limits[1])
 
-        self.spectra_plot_box.setMaximum(len(self.sample.__dict__[self.bgSpecSelect.currentText()].I)-1)
+        self.spectra_plot_box.setMaximum(self.view.n_spectra-1)
         self.spectra_plot_box.setMinimum(0)
 
-        
-        if len(self.sample.bg_info[self.bgSpecSelect.currentText()]) > 2:
-            self.parB_Box.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][2][0])
-            self.parC_Box.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][2][2])
-            self.Bslider.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][2][0])
-            self.Cslider.setValue(self.sample.bg_info[self.bgSpecSelect.currentText()][2][2])
-            self.parB_cb.setChecked(bool(self.sample.bg_info[self.bgSpecSelect.currentText()][2][0]))
-            self.parC_cb.setChecked(bool(self.sample.bg_info[self.bgSpecSelect.currentText()][2][3]))
+        ut2 = self.view.ut2
+        if ut2 is not None:
+            self.parB_Box.setValue(ut2[0])
+            self.parC_Box.setValue(ut2[2])
+            self.Bslider.setValue(int(ut2[0]))
+            self.Cslider.setValue(int(ut2[2]))
+            self.parB_cb.setChecked(bool(ut2[0]))
+            self.parC_cb.setChecked(bool(ut2[3]))
             
-            self.UT2params['B'].set(value =self.sample.bg_info[self.bgSpecSelect.currentText()][2][0], min = 0,vary = self.sample.bg_info[self.bgSpecSelect.currentText()][2][1])
-            self.UT2params['C'].set(value =self.sample.bg_info[self.bgSpecSelect.currentText()][2][2], min = 0,vary = self.sample.bg_info[self.bgSpecSelect.currentText()][2][3])
+            self.UT2params['B'].set(value = ut2[0], min = 0,vary = ut2[1])
+            self.UT2params['C'].set(value = ut2[2], min = 0,vary = ut2[3])
             self.UT2params['D'].set(value =0, min = 0,vary = 0)
         else:
 
@@ -167,6 +271,20 @@ class bgSubWindow(QMainWindow):
             self.parB_cb.setChecked(False)
             self.parC_cb.setChecked(False)
 
+        for w in widgets:
+            w.blockSignals(False)
+        self.request_redraw()
+
+    def request_redraw(self):
+        if self.subtracting:
+            return
+        if not self.redraw_timer.isActive():
+            # First request of a new user action
+            self.redraw_requests = 0
+            self.tougaard_misses = self.tougaard_cache.backgrounds.misses
+            self.redraw_timer.start()
+        self.redraw_requests += 1
+
     def set_bgPars(self):
         self.sample.bg_info[self.bgSpecSelect.currentText()][1] = self.bgTypeBox.currentText()
         self.sample.bg_info[self.bgSpecSelect.currentText()][0] = tuple([self.minBox.value(),self.maxBox.value()])
@@ -175,6 +293,7 @@ class bgSubWindow(QMainWindow):
                 self.sample.bg_info[self.bgSpecSelect.currentText()][2] = tuple([self.parB_Box.value(),int(self.parB_cb.isChecked()),self.parC_Box.value(),int(self.parC_cb.isChecked())])
             else:
                 self.sample.bg_info[self.bgSpecSelect.currentText()].append(tuple([self.parB_Box.value(),int(self.parB_cb.isChecked()),self.parC_Box.value(),int(self.parC_cb.isChecked())]))
+        changes.mark_dirty(self.sample, 'bg_info', self.bgSpecSelect.currentText())
 
 
     def BGSubtract(self):
@@ -184,24 +303,63 @@ class bgSubWindow(QMainWindow):
         subpars = [bg_limits,bgtype]
         if bgtype == 'UT2':
             subpars.append([self.parB_Box.value(),int(self.parB_cb.isChecked()),self.parC_Box.value(),int(self.parC_cb.isChecked())])
-        self.sample.__dict__[orbital].bg_sub(subpars=subpars)
+        try:
+            bg_engine.run_bg_sub(self.sample.__dict__[orbital], subpars, batch = self.batch_bg_cb.isChecked())
+        except Exception as e:
+            self.statusBar().showMessage('Background subtraction failed: '+str(e), 5000)
+            print('Background subtraction failed for',orbital,':',e)
+            return
 
         self.sample.bg_info[orbital] = self.sample.__dict__[orbital].bg_info
+        changes.mark_dirty(self.sample, 'bg_info', orbital)
         self.load_bgVals()
-        self.update_plot()
 
 
+    def preview_widgets(self):
+        return [self.bgSpecSelect, self.bgTypeBox, self.minBox, self.maxBox, self.spectra_plot_box, self.parB_Box, \
+            self.parC_Box, self.parB_cb, self.parC_cb, self.Bslider, self.Cslider, self.BminBox, self.BmaxBox, \
+            self.CminBox, self.CmaxBox, self.setBG_Button, self.BGSubtract_Button, self.BGSubtractAll_Button, \
+            self.batch_bg_cb, self.grid_cb]
+
+    def BGSubtractAll(self):
+        # The workers swap esub, isub and bg underneath the plot, a redraw halfway
+        # through could pair a new esub with an old bg, so nothing redraws until done
+        self.subtracting = True
+        self.redraw_timer.stop()
+        for w in self.preview_widgets():
+            w.setEnabled(False)
+        self.pipeline_worker = BGPipelineWorker(self.sample, batch = self.batch_bg_cb.isChecked())
+        self.pipeline_thread = QThread(self)
+        self.pipeline_worker.moveToThread(self.pipeline_thread)
+
+        self.pipeline_thread.started.connect(self.pipeline_worker.run)
+        self.pipeline_worker.orbitalDone.connect(lambda orb: self.statusBar().showMessage('Subtracted '+orb))
+        self.pipeline_worker.orbitalFailed.connect(lambda orb, err: print('Background subtraction failed for',orb,':',err))
+        self.pipeline_worker.finished.connect(self.pipeline_thread.quit)
+        self.pipeline_thread.finished.connect(self.BGSubtractAll_finished)
+        self.pipeline_thread.start()
+
+    def BGSubtractAll_finished(self):
+        self.pipeline_thread.deleteLater()
+        self.pipeline_worker.deleteLater()
+        self.subtracting = False
+        for w in self.preview_widgets():
+            w.setEnabled(True)
+        self.statusBar().showMessage('All orbitals background subtracted', 2000)
+        self.load_bgVals()
+        self.allSubtracted.emit()
+
     def update_slider(self):
         sender = self.sender()
         sliderpts = 100
         if sender.objectName() == 'B':
             v = self.parB_Box.value()
-            self.Bslider.setValue(v)
+            self.Bslider.setValue(int(v))
             self.UT2params['B'].set(v)
 
         elif sender.objectName() == 'C':
             v = self.parC_Box.value()
-            self.Cslider.setValue(v)
+            self.Cslider.setValue(int(v))
             self.UT2params['C'].set(v)
 
 
@@ -275,6 +433,25 @@ class bgSubWindow(QMainWindow):
         
         QMessageBox.information(self, "Click!", msg)
     
+    def tougaard_background(self):
+        """UT2 background of the spectrum on display.
+
+        By default it is bksb.Tougaard's, the same BG Subtract applies, cached per
+        spectrum and settings. With Batch backgrounds checked and B and C fixed the
+        cached numpy B = 1 background is just rescaled instead.
+        """
+        orbital = self.view.orbital
+        idx = self.spectra_plot_box.value()
+        I = self.view.spectra.I[idx]
+        E = self.view.spectra.E
+        B, C, D = [self.UT2params[p].value for p in ['B','C','D']]
+
+        if (not self.batch_bg_cb.isChecked()) or self.UT2params['B'].vary or self.UT2params['C'].vary:
+            key = ('bksb', orbital, idx, B, C, D, self.UT2params['B'].vary, self.UT2params['C'].vary, \
+                self.view.Emin, self.view.Emax)
+            return self.tougaard_cache.backgrounds.get(key, lambda: bksb.Tougaard(self.UT2params, I, E)[0])
+        return self.tougaard_cache.background(orbital, idx, I, E, B, C, D, window = (self.view.Emin, self.view.Emax))
+
     def update_plot(self):
         """ Redraws the figure
         """
@@ -282,31 +459,37 @@ class bgSubWindow(QMainWindow):
         # clear the axes and redraw the plot anew
         #
 
+        self.redraw_timer.stop()
+        if self.subtracting:
+            return
+        spectra = self.view.spectra
+        idx = self.spectra_plot_box.value()
+
         self.axes.cla()        
 
         self.axes.grid(self.grid_cb.isChecked())
         
-        self.axes.plot(self.sample.__dict__[self.bgSpecSelect.currentText()].E, self.sample.__dict__[self.bgSpecSelect.currentText()].I[self.spectra_plot_box.value()],'o')
+        self.axes.plot(spectra.E, spectra.I[idx],'o')
 
-        if hasattr(self.sample.__dict__[self.bgSpecSelect.currentText()],'bg'):
-            if self.sample.bg_info[self.bgSpecSelect.currentText()][1] == 'UT2':
-                bgoffset = self.sample.__dict__[self.bgSpecSelect.currentText()].I[self.spectra_plot_box.value()][-1]
+        if hasattr(spectra,'bg'):
+            if self.view.bgtype == 'UT2':
+                bgoffset = spectra.I[idx][-1]
 
-                UTbg,subtr = bksb.Tougaard(self.UT2params, self.sample.__dict__[self.bgSpecSelect.currentText()].I[self.spectra_plot_box.value()],self.sample.__dict__[self.bgSpecSelect.currentText()].E)
-                self.axes.plot(self.sample.__dict__[self.bgSpecSelect.currentText()].E, UTbg+bgoffset,'-')
+                UTbg = self.tougaard_background()
+                self.axes.plot(spectra.E, UTbg+bgoffset,'-')
             else:
                 bgoffset = 0
-                self.axes.plot(self.sample.__dict__[self.bgSpecSelect.currentText()].esub, self.sample.__dict__[self.bgSpecSelect.currentText()].bg[self.spectra_plot_box.value()]+bgoffset,'-')
+                self.axes.plot(spectra.esub, spectra.bg[idx]+bgoffset,'-')
 
-        if self.sample.bg_info[self.bgSpecSelect.currentText()][1] == 'shirley':
+        if self.view.bgtype == 'shirley':
             # self.axes.axvspan( np.min(self.sample.bg_info[self.bgSpecSelect.currentText()][0]), np.max(self.sample.bg_info[self.bgSpecSelect.currentText()][0]) , alpha=0.1, color='orange')
             self.axes.axvspan( self.minBox.value(), self.maxBox.value(), alpha=0.1, color='orange')
 
-        elif self.sample.bg_info[self.bgSpecSelect.currentText()][1] == 'linear':
+        elif self.view.bgtype == 'linear':
             # self.axes.axvspan( np.min(self.sample.bg_info[self.bgSpecSelect.currentText()][0]), np.max(self.sample.bg_info[self.bgSpecSelect.currentText()][0]) , alpha=0.1, color='green')
             self.axes.axvspan( self.minBox.value(), self.maxBox.value(), alpha=0.1, color='green')
 
-        elif self.sample.bg_info[self.bgSpecSelect.currentText()][1] == 'UT2':
+        elif self.view.bgtype == 'UT2':
             # self.axes.axvspan( np.min(self.sample.bg_info[self.bgSpecSelect.currentText()][0]), np.max(self.sample.bg_info[self.bgSpecSelect.currentText()][0]) , alpha=0.1, color='blue')
             self.axes.axvspan( self.minBox.value(), self.maxBox.value(), alpha=0.1, color='blue')
 
@@ -315,10 +498,19 @@ class bgSubWindow(QMainWindow):
 
         self.axes.set_xlabel('Binding Energy (eV)',fontsize=24)
         self.axes.set_ylabel('Counts/sec',fontsize=24)
-        self.axes.set_xlim(np.max(self.sample.__dict__[self.bgSpecSelect.currentText()].E),np.min(self.sample.__dict__[self.bgSpecSelect.currentText()].E))
+        self.axes.set_xlim(self.view.Emax,self.view.Emin)
         self.axes.tick_params(labelsize=20)
         self.fig.tight_layout()
         self.canvas.draw()
+        self.show_redraw_count()
+
+    def show_redraw_count(self):
+        if not hasattr(self,'redraw_text'):
+            return
+        self.redraw_text.setText('Last action: %d redraw requests, %d Tougaard evaluations' \
+            % (self.redraw_requests, self.tougaard_cache.backgrounds.misses - self.tougaard_misses))
+        self.redraw_requests = 0
+        self.tougaard_misses = self.tougaard_cache.backgrounds.misses
 
 
 
@@ -355,7 +547,7 @@ class bgSubWindow(QMainWindow):
 
         self.grid_cb = QCheckBox("Show &Grid")
         self.grid_cb.setChecked(False)
-        self.grid_cb.stateChanged.connect(self.update_plot)
+        self.grid_cb.stateChanged.connect(self.request_redraw)
 
 
 
@@ -400,6 +592,8 @@ class bgSubWindow(QMainWindow):
         hbox_main.addWidget(self.setBG_Button)
 
         hbox_main.addWidget(self.BGSubtract_Button)
+        hbox_main.addWidget(self.BGSubtractAll_Button)
+        hbox_main.addWidget(self.batch_bg_cb)
 
         vbox = QVBoxLayout()
         vbox.addWidget(self.canvas)
@@ -414,8 +608,10 @@ class bgSubWindow(QMainWindow):
 
 
     def create_status_bar(self):
-        self.status_text = QLabel("This is a demo")
+        self.status_text = QLabel("")
         self.statusBar().addWidget(self.status_text, 1)
+        self.redraw_text = QLabel("")
+        self.statusBar().addPermanentWidget(self.redraw_text)
         
     def create_menu(self):        
         self.file_menu = self.menuBar().addMenu("&File")
@@ -0,0 +1,264 @@
+"""
+Background calculations for bgSubWindow.
+
+Only numpy is used here so the same code can be shared by the preview plot
+and the background subtraction. The subtraction itself still goes through
+XPyS unless batch backgrounds are asked for, see run_bg_sub.
+"""
+from collections import OrderedDict
+import numpy as np
+
+import changes
+
+
+class EnergyIndex:
+    """What is needed about an orbital's energy axis, worked out once.
+
+    Holds the range, the direction of the axis and its ascending order, and
+    the index slice of every energy window asked for so far, found with
+    searchsorted instead of masking E each time.
+    """
+
+    def __init__(self, E):
+        self.E = E
+        E = np.asarray(E)
+        steps = np.diff(E)
+        self.descending = bool(len(E) > 1) and (E[0] > E[-1])
+        self.monotonic = bool(np.all(steps < 0)) if self.descending else bool(np.all(steps > 0))
+        self.Emin = float(np.min(E))
+        self.Emax = float(np.max(E))
+        self.sorted = E[::-1] if self.descending else E
+        self._windows = {}
+
+    def window(self, bg_limits):
+        """Index slice of E inside bg_limits"""
+        lo, hi = float(np.min(bg_limits)), float(np.max(bg_limits))
+        if (lo, hi) not in self._windows:
+            if self.monotonic:
+                n = len(self.sorted)
+                start = int(np.searchsorted(self.sorted, lo, side = 'left'))
+                stop = int(np.searchsorted(self.sorted, hi, side = 'right'))
+                window = slice(n - stop, n - start) if self.descending else slice(start, stop)
+            else:
+                E = np.asarray(self.E)
+                idx = np.flatnonzero((E >= lo) & (E <= hi))
+                window = slice(int(idx[0]), int(idx[-1])+1)
+            self._windows[(lo, hi)] = window
+        return self._windows[(lo, hi)]
+
+
+def energy_index(spectra_obj, name = 'E'):
+    """EnergyIndex of an energy axis of spectra_obj (E or esub), kept on the object
+    until the axis itself is replaced"""
+    key = '_energy_index_' + name
+    axis = getattr(spectra_obj, name)
+    index = spectra_obj.__dict__.get(key)
+    if (index is None) or (index.E is not axis):
+        index = EnergyIndex(axis)
+        spectra_obj.__dict__[key] = index
+    return index
+
+
+def energy_differences(E):
+    """Loss energies T[k,j] = |E[j]-E[k]| for j > k, zero elsewhere, and the step dE[j]
+
+    Only depends on the energy axis so it can be reused for every spectrum and
+    every B, C, D of an orbital.
+    """
+    T = np.triu(np.abs(E[None,:] - E[:,None]), k = 1)
+    dE = np.abs(np.gradient(E))
+    return T, dE
+
+
+def tougaard_kernel(T, dE, C, D = 0):
+    """UT2 loss function T/((C + T^2)^2 + D T^2) weighted by the energy step, per unit B"""
+    # Only j > k (T > 0) contributes, and with C = 0 the rest would be 0/0
+    K = np.divide(T, (C + T**2)**2 + D*T**2, out = np.zeros_like(T), where = T > 0)
+    return K*dE[None,:]
+
+
+def tougaard(I, K, B = 1):
+    """Tougaard background of I (one spectrum or a n_spectra x n_energies matrix)
+
+    The background at point k integrates the intensity at every later point j,
+    so it is zero at the last point of the energy axis.
+    """
+    return B*np.dot(I, K.T)
+
+
+class LRUCache(OrderedDict):
+    """Small least-recently-used cache, oldest entries are dropped past maxsize.
+
+    misses counts the values that had to be computed.
+    """
+
+    def __init__(self, maxsize = 128):
+        super().__init__()
+        self.maxsize = maxsize
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        value = compute()
+        self.misses += 1
+        self[key] = value
+        if len(self) > self.maxsize:
+            self.popitem(last = False)
+        return value
+
+
+class TougaardCache:
+    """Cached Tougaard backgrounds for the bgSubWindow preview.
+
+    The background is linear in B, so only the B = 1 background is stored per
+    (orbital, spectrum index, C, D, energy window). Dragging B is then a single
+    multiply, and the O(N^2) integral is only redone when C, D, the spectrum or
+    the window change. The energy difference matrix is kept per (orbital, window).
+    """
+
+    def __init__(self, maxsize = 128):
+        self.backgrounds = LRUCache(maxsize)
+        self.differences = LRUCache(16)
+
+    def background(self, orbital, index, I, E, B, C, D = 0, window = None):
+        if window is None:
+            window = (np.min(E), np.max(E))
+        T, dE = self.differences.get((orbital, window), lambda: energy_differences(E))
+        unit = self.backgrounds.get((orbital, index, C, D, window), lambda: tougaard(I, tougaard_kernel(T, dE, C, D)))
+        return B*unit
+
+    def clear(self, orbital = None):
+        """Forget cached backgrounds, for one orbital or all of them"""
+        for cache in [self.backgrounds, self.differences]:
+            for key in [k for k in cache.keys() if (orbital is None) or (k[0] == orbital)]:
+                del cache[key]
+
+
+"""Batch background subtraction. These work on the whole I matrix of an orbital
+(n_spectra x n_energies) at once instead of looping over spectra."""
+def window_slice(E, bg_limits):
+    """Index slice of the energy axis inside bg_limits"""
+    return EnergyIndex(E).window(bg_limits)
+
+
+def linear_background(I, E):
+    """Straight line between the first and last point of every spectrum"""
+    frac = (E - E[0])/(E[-1] - E[0])
+    return I[:,:1] + (I[:,-1:] - I[:,:1])*frac[None,:]
+
+
+def shirley_background(I, E, tol = 1e-5, maxit = 50):
+    """Iterative Shirley background for every row of I.
+
+    Each row keeps iterating until its own background stops changing, rows that
+    have converged are masked out of the following iterations.
+    """
+    dE = np.abs(np.diff(E))
+    I_start = I[:,:1]
+    I_end = I[:,-1:]
+    bg = np.repeat(I_end, I.shape[1], axis = 1).astype(float)
+    active = np.arange(I.shape[0])
+    tol = tol*np.max(np.abs(I), axis = 1)
+
+    for it in range(maxit):
+        Y = I[active] - bg[active]
+        area = 0.5*(Y[:,1:] + Y[:,:-1])*dE[None,:]
+        # Area between each point and the end of the spectrum
+        A = np.concatenate([np.cumsum(area[:,::-1], axis = 1)[:,::-1], np.zeros((len(active),1))], axis = 1)
+        A_total = A[:,:1]
+        A_total[A_total == 0] = 1
+        new_bg = I_end[active] + (I_start[active] - I_end[active])*A/A_total
+
+        converged = np.max(np.abs(new_bg - bg[active]), axis = 1) < tol[active]
+        bg[active] = new_bg
+        active = active[~converged]
+        if len(active) == 0:
+            break
+    return bg
+
+
+def ut2_background(I, E, B, C, D = 0):
+    """UT2 background of every row of I, offset to the last point like the preview"""
+    T, dE = energy_differences(E)
+    return tougaard(I, tougaard_kernel(T, dE, C, D), B) + I[:,-1:]
+
+
+def subtract(E, I, subpars, index = None):
+    """Background subtract the whole I matrix with bg_info style subpars
+
+    subpars is [bg_limits, bgtype] with (B, vary B, C, vary C) appended for UT2.
+    index is the EnergyIndex of E if there is one already. esub and the window
+    of I are views, not copies. Returns esub, isub and bg.
+    """
+    window = (index if index is not None else EnergyIndex(E)).window(subpars[0])
+    esub = E[window]
+    Iw = np.atleast_2d(I)[:,window]
+    bgtype = subpars[1]
+    if bgtype == 'linear':
+        bg = linear_background(Iw, esub)
+    elif bgtype == 'shirley':
+        bg = shirley_background(Iw, esub)
+    elif bgtype == 'UT2':
+        bg = ut2_background(Iw, esub, subpars[2][0], subpars[2][2])
+    else:
+        raise ValueError('Unknown background type: %s' % bgtype)
+    return esub, Iw - bg, bg
+
+
+def can_batch(subpars):
+    """UT2 with B or C set to vary needs a fit per spectrum, which bksb does"""
+    return not ((subpars[1] == 'UT2') and (subpars[2][1] or subpars[2][3]))
+
+
+def bg_sub(spectra_obj, subpars):
+    """Batch version of spectra_obj.bg_sub. Returns False if subpars can't be batched."""
+    if not can_batch(subpars):
+        return False
+    spectra_obj.esub, spectra_obj.isub, spectra_obj.bg = subtract(spectra_obj.E, spectra_obj.I, subpars, \
+        index = energy_index(spectra_obj))
+    spectra_obj.bg_info = subpars
+    mark_bg_dirty(spectra_obj)
+    return True
+
+
+def mark_bg_dirty(spectra_obj):
+    for field in ['esub','isub','bg','bg_info']:
+        changes.mark_dirty(spectra_obj, field)
+
+
+def bg_version(spectra_obj):
+    """Number of the background subtraction spectra_obj's isub came from, changes with
+    every new one (each mark_bg_dirty gives isub a new changes.version)"""
+    return changes.version(spectra_obj, 'isub')
+
+
+def run_bg_sub(spectra_obj, subpars, batch = False):
+    """Background subtract with the spectra object's own bg_sub (XPyS/bksb).
+
+    With batch the numpy backgrounds here are used instead wherever subpars
+    allow it. They are faster but only a stand-in until check_backgrounds.py
+    shows they agree with bksb, which is why they aren't the default.
+    """
+    if batch and bg_sub(spectra_obj, subpars):
+        return
+    spectra_obj.bg_sub(subpars=subpars)
+    mark_bg_dirty(spectra_obj)
+
+
+def compare_backgrounds(spectra_obj, subpars):
+    """Largest difference between the batch background of spectra_obj and the one
+    its own bg_sub makes, per spectrum, relative to that spectrum's peak height.
+
+    spectra_obj is left as its own bg_sub made it. Backgrounds of different
+    shapes (e.g. different energy windows) count as infinitely far apart.
+    """
+    esub, isub, bg = subtract(spectra_obj.E, spectra_obj.I, subpars)
+    spectra_obj.bg_sub(subpars=subpars)
+    ref = np.atleast_2d(spectra_obj.bg)
+    if ref.shape != bg.shape:
+        return np.full(len(bg), np.inf)
+    height = np.ptp(np.atleast_2d(spectra_obj.I), axis = 1)
+    height[height == 0] = 1
+    return np.max(np.abs(bg - ref), axis = 1) / height
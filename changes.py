@@ -0,0 +1,187 @@
+"""
+Change tracking for samples and spectra objects, so saves only rewrite what
+was modified.
+
+Each spectra object carries a _dirty dict of field -> True (the whole field
+changed) or a set of spectrum indices (only those rows/fit results changed).
+An object without _dirty has never been loaded or saved through here and is
+treated as entirely dirty. A sample tracks its own fields the same way, with
+orbital names as the indices of its bg_info.
+
+A save takes the dict off the object (take_dirty) and writes from that, so
+anything marked meanwhile, e.g. by a fit running during an autosave, lands in
+a fresh dict and is saved next time. A failed write puts it back.
+
+Whether an object needs saving at all is decided from its content instead
+(changed): every mark also gives the field a new version number, and the
+versions and the params as params.dumps() are compared with what they were
+when the object was last loaded or saved (mark_saved). Parameter edits that
+mark nothing are caught that way too.
+"""
+import itertools
+import threading
+
+_lock = threading.Lock()
+# Version numbers, unique across all objects so they never repeat for new data
+_versions = itertools.count(1)
+
+
+def mark_dirty(obj, field, index = None):
+    with _lock:
+        dirty = obj.__dict__.setdefault('_dirty', {})
+        if index is None:
+            dirty[field] = True
+        elif dirty.get(field) is not True:
+            dirty.setdefault(field, set()).add(index)
+        obj.__dict__.setdefault('_versions', {})[field] = next(_versions)
+
+
+def version(obj, field):
+    """Version of field, changes with every mark. A field never marked (as loaded)
+    shares one number per object."""
+    with _lock:
+        versions = obj.__dict__.get('_versions', {})
+        if field in versions:
+            return versions[field]
+        if '_loaded_version' not in obj.__dict__:
+            obj.__dict__['_loaded_version'] = next(_versions)
+        return obj.__dict__['_loaded_version']
+
+
+def _params_dump(obj):
+    params = obj.__dict__.get('params')
+    return None if params is None else params.dumps()
+
+
+def content(obj):
+    """What changed compares: the field versions and the params"""
+    with _lock:
+        versions = dict(obj.__dict__.get('_versions', {}))
+    return versions, _params_dump(obj)
+
+
+def mark_saved(obj, saved = None):
+    """obj is as in the file, or was when saved = content(obj) was taken"""
+    obj.__dict__['_saved'] = content(obj) if saved is None else saved
+
+
+def params_loaded(obj):
+    """obj's params were just read from the file, so they are as saved"""
+    versions, params = obj.__dict__.get('_saved', ({}, None))
+    obj.__dict__['_saved'] = (versions, _params_dump(obj))
+
+
+def changed(obj):
+    """Does obj differ from what was last loaded or saved. Objects never loaded or
+    saved through here always do."""
+    return ('_saved' not in obj.__dict__) or (content(obj) != obj.__dict__['_saved'])
+
+
+def mark_all_dirty(obj):
+    """Forget what is known to have changed, so everything is written next time"""
+    obj.__dict__.pop('_dirty', None)
+
+
+def mark_clean(obj):
+    obj.__dict__['_dirty'] = {}
+
+
+def is_tracked(obj):
+    return '_dirty' in obj.__dict__
+
+
+def take_dirty(obj):
+    """Take obj's changes off it for writing, None if it is untracked (write everything)"""
+    with _lock:
+        dirty = obj.__dict__.get('_dirty')
+        obj.__dict__['_dirty'] = {}
+    return dirty
+
+
+def restore_dirty(obj, taken):
+    """Put back what take_dirty took after a failed write, merged with anything marked since"""
+    with _lock:
+        if taken is None:
+            obj.__dict__.pop('_dirty', None)
+            return
+        dirty = obj.__dict__.setdefault('_dirty', {})
+        for field, value in taken.items():
+            if (value is True) or (dirty.get(field) is True):
+                dirty[field] = True
+            else:
+                dirty.setdefault(field, set()).update(value)
+
+
+def take_index(obj, field, index):
+    """Take one index of field's changes off obj, e.g. an orbital of the sample's
+    bg_info saved on its own. Returns whether it was marked, to mark it again
+    if the write fails."""
+    with _lock:
+        indices = obj.__dict__.get('_dirty', {}).get(field)
+        if not isinstance(indices, set):
+            return False
+        taken = index in indices
+        indices.discard(index)
+        if indices == set():
+            del obj.__dict__['_dirty'][field]
+        return taken
+
+
+def field_dirty(dirty, field = None):
+    """is_dirty for a dict taken with take_dirty"""
+    if dirty is None:
+        return True
+    if field is None:
+        return dirty != {}
+    return field in dirty
+
+
+def field_indices(dirty, field, n):
+    """dirty_indices for a dict taken with take_dirty"""
+    if (dirty is None) or (dirty.get(field) is True):
+        return list(range(n))
+    return sorted(dirty.get(field, set()))
+
+
+def is_dirty(obj, field = None):
+    """Has field (or anything, with field None) changed since the last save"""
+    return field_dirty(obj.__dict__.get('_dirty'), field)
+
+
+def dirty_indices(obj, field, n):
+    """Indices of field that need writing, every index if the whole field is dirty"""
+    return field_indices(obj.__dict__.get('_dirty'), field, n)
+
+
+def mark_sample_clean(sample):
+    """Nothing to save, e.g. just loaded"""
+    mark_clean(sample)
+    for orbital in sample.element_scans:
+        mark_clean(sample.__dict__[orbital])
+        mark_saved(sample.__dict__[orbital])
+
+
+def take_sample_dirty(sample):
+    """take_dirty of the sample and every orbital, for a save that writes all of them"""
+    return [(obj, take_dirty(obj)) for obj in [sample] + [sample.__dict__[orb] for orb in sample.element_scans]]
+
+
+def restore_all(taken):
+    for obj, dirty in taken:
+        restore_dirty(obj, dirty)
+
+
+def changed_orbitals(sample, dirty):
+    """Orbitals with anything to save given the sample's own changes, dirty"""
+    if dirty is None:
+        return list(sample.element_scans)
+    bg_changed = dirty.get('bg_info', set())
+    if bg_changed is True:
+        return list(sample.element_scans)
+    return [orbital for orbital in sample.element_scans \
+        if (orbital in bg_changed) or is_dirty(sample.__dict__[orbital]) or changed(sample.__dict__[orbital])]
+
+
+def dirty_orbitals(sample):
+    """Orbitals with anything to save, cheap enough to poll from a timer"""
+    return changed_orbitals(sample, sample.__dict__.get('_dirty'))
@@ -0,0 +1,54 @@
+"""
+Check the numpy batch backgrounds in bg_engine against XPyS bg_sub on real spectra.
+
+Every orbital of the experiment (or the ones given with -o) is background
+subtracted both ways with its saved bg_info, or with the types given with -t,
+and the largest difference relative to each spectrum's peak height is
+reported. Nothing is saved. Exits with 1 when anything is further apart than
+--tol, so batch backgrounds (bgSubWindow's checkbox, xps_batch --batch-bg)
+should only be used for what passes here.
+
+    python check_backgrounds.py sample.hdf5 -e surface_profile_1
+    python check_backgrounds.py sample.hdf5 -e surface_profile_1 -o Nb3d -t linear -t shirley
+"""
+import sys
+import argparse
+import numpy as np
+sys.path.append("/Users/cassberk/code")
+import XPyS.io
+
+import bg_engine
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Compare bg_engine batch backgrounds with XPyS bg_sub')
+    parser.add_argument('path', help = 'sample .hdf5 file')
+    parser.add_argument('-e','--experiment', required = True, help = 'experiment name inside the sample file')
+    parser.add_argument('-o','--orbital', action = 'append', default = [], help = 'orbital to check (default: all)')
+    parser.add_argument('-t','--bgtype', action = 'append', default = [], choices = ['linear','shirley','UT2'], \
+        help = 'background type to check in the saved window (default: the saved bg_info)')
+    parser.add_argument('--tol', type = float, default = 1e-3, help = 'largest allowed difference / peak height')
+    args = parser.parse_args(argv)
+
+    sample = XPyS.io.load_sample(filepath = args.path, experiment_name = args.experiment)
+    failed = 0
+    for orbital in (args.orbital if args.orbital != [] else sample.element_scans):
+        saved = list(sample.bg_info[orbital])
+        checks = [saved] if args.bgtype == [] else [[saved[0], t] + saved[2:] for t in args.bgtype]
+        for subpars in checks:
+            if not bg_engine.can_batch(subpars):
+                print('  %-8s %-8s UT2 with B or C varying is never batched' % (orbital, subpars[1]))
+                continue
+            if (subpars[1] == 'UT2') and (len(subpars) < 3):
+                print('  %-8s %-8s no saved B and C to check with' % (orbital, subpars[1]))
+                continue
+            diff = bg_engine.compare_backgrounds(sample.__dict__[orbital], subpars)
+            ok = bool(np.all(diff <= args.tol))
+            failed += not ok
+            print('  %-8s %-8s max %.2e, median %.2e over %d spectra  %s' \
+                % (orbital, subpars[1], np.max(diff), np.median(diff), len(diff), 'ok' if ok else 'DIFFERENT'))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
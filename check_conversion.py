@@ -0,0 +1,101 @@
+"""
+Check the file by file .avg conversion in avgtohdf5 against XPyS.avg.avg_to_hdf5.
+
+The same .avg files are converted twice into a temporary directory: once by
+XPyS.avg.avg_to_hdf5 given all of them, once a file at a time the way the
+Convert dialog does it (parse_avg and ExperimentWriter). Every dataset and
+attribute of the two experiments is compared. Nothing is written next to the
+.avg files. Exits with 1 on any difference, so the dialog's merge should only
+be trusted for scans that pass here.
+
+    python check_conversion.py scan_*.avg -s sample_1 -e surface_profile_1
+"""
+import sys, os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import h5py
+sys.path.append("/Users/cassberk/code")
+import XPyS.avg
+
+import avgtohdf5
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def same(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    if a.shape != b.shape:
+        return False
+    if (a.dtype.kind in 'biuf') and (b.dtype.kind in 'biuf'):
+        return np.allclose(a, b, equal_nan = True)
+    return [decode(v) for v in a.ravel().tolist()] == [decode(v) for v in b.ravel().tolist()]
+
+
+def compare_attrs(name, expected, found):
+    problems = []
+    for key in sorted(set(expected.attrs.keys()) | set(found.attrs.keys())):
+        if key not in found.attrs:
+            problems.append('%s: attribute %s missing' % (name, key))
+        elif key not in expected.attrs:
+            problems.append('%s: attribute %s not written by XPyS' % (name, key))
+        elif not same(expected.attrs[key], found.attrs[key]):
+            problems.append('%s: attribute %s differs' % (name, key))
+    return problems
+
+
+def compare(expected, found):
+    """Differences between two experiment groups, as a list of strings"""
+    problems = compare_attrs('/', expected.file, found.file) + compare_attrs(expected.name, expected, found)
+    names = []
+    expected.visit(names.append)
+    found.visit(lambda name: None if name in expected else problems.append('%s not written by XPyS' % name))
+    for name in names:
+        if name not in found:
+            problems.append('%s missing' % name)
+            continue
+        problems += compare_attrs(name, expected[name], found[name])
+        if isinstance(expected[name], h5py.Dataset):
+            if expected[name].shape != found[name].shape:
+                problems.append('%s has shape %s, XPyS %s' % (name, found[name].shape, expected[name].shape))
+            elif not same(expected[name][()], found[name][()]):
+                problems.append('%s differs' % name)
+    return problems
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Compare the Convert dialog\'s .avg merge with XPyS.avg.avg_to_hdf5')
+    parser.add_argument('avgfiles', nargs = '+', help = '.avg files of one experiment, in order')
+    parser.add_argument('-s','--sample', required = True, help = 'sample name')
+    parser.add_argument('-e','--experiment', required = True, help = 'experiment name')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        expected_path = os.path.join(tmpdir, 'xpys.hdf5')
+        XPyS.avg.avg_to_hdf5(sample_name = args.sample, experiment_name = args.experiment, \
+            avgfiles = args.avgfiles, savepath = expected_path, force = False)
+
+        found_path = os.path.join(tmpdir, 'converted.hdf5')
+        with h5py.File(found_path, 'w') as f, h5py.File(os.path.join(tmpdir, 'rows.hdf5'), 'w') as scratch:
+            writer = avgtohdf5.ExperimentWriter(f.require_group(args.experiment), scratch)
+            for avgfile in args.avgfiles:
+                writer.add(avgtohdf5.parse_avg(avgfile, args.sample, args.experiment))
+            writer.write()
+
+        with h5py.File(expected_path, 'r') as e, h5py.File(found_path, 'r') as f:
+            problems = compare(e[args.experiment], f[args.experiment])
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for problem in problems:
+        print('  ' + problem)
+    print('%d files: %s' % (len(args.avgfiles), 'same as XPyS' if problems == [] else '%d differences' % len(problems)))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
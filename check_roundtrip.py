@@ -0,0 +1,150 @@
+"""
+Check that an analysis saved through sample_io reads back the same.
+
+Without a file a small synthetic sample is made in a temporary directory,
+background subtracted, fit and saved. With one, a copy of it is used and its
+saved analysis is written again; the original is never touched. Either way
+the copy is then loaded both ways the GUI loads (lazily, and the way
+load_saved_analysis completes an XPyS.io load) and the params, model,
+background subtraction and fit results are compared with what was saved.
+Exits with 1 on any difference.
+
+    python check_roundtrip.py
+    python check_roundtrip.py sample.hdf5 -e surface_profile_1
+"""
+import sys, os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import h5py
+import lmfit as lm
+
+import bg_engine
+import changes
+import fitting
+import sample_io
+
+
+def make_sample(filepath, n = 6):
+    """Two orbitals of n spectra with two peaks each on a step, like a depth profile"""
+    E = np.linspace(10, 0, 200)
+    rng = np.random.default_rng(0)
+    with h5py.File(filepath, 'w') as f:
+        experiment = f.create_group('roundtrip')
+        experiment.attrs['sample_name'] = 'roundtrip'
+        for orbital, centers in [('Nb3d', (3.5, 6.0)), ('O1s', (4.0, 5.5))]:
+            grp = experiment.create_group(orbital)
+            grp['E'] = E
+            I = [a*np.exp(-(E-centers[0])**2/0.5) + (1-a)*np.exp(-(E-centers[1])**2/0.5) + 0.2*(E > 5) \
+                + 0.01*rng.standard_normal(len(E)) for a in np.linspace(0.2, 0.8, n)]
+            grp['I'] = np.array(I)
+            grp.attrs['bg_info'] = str([(1.0, 9.0), 'shirley'])
+
+
+def analyse(sample, orbital):
+    spectra_obj = sample.__dict__[orbital]
+    bg_engine.bg_sub(spectra_obj, list(sample.bg_info[orbital]))
+    mod = lm.models.GaussianModel(prefix = 'a_') + lm.models.GaussianModel(prefix = 'b_')
+    spectra_obj.mod = mod
+    spectra_obj.params = mod.make_params(a_amplitude = 0.5, a_center = 3.5, a_sigma = 0.5, \
+        b_amplitude = 0.5, b_center = 6.0, b_sigma = 0.5)
+    changes.mark_dirty(spectra_obj, 'params')
+    fit_results = fitting.empty_fit_results(spectra_obj)
+    for i in range(0, len(spectra_obj.isub), 2):
+        fit_results[i] = fitting.fit_spectrum(spectra_obj.mod, spectra_obj.params.copy(), spectra_obj.esub, spectra_obj.isub[i])
+        changes.mark_dirty(spectra_obj, 'fit_results', i)
+
+
+class LoadedSpectra:
+    """What XPyS.io.load_sample gives for an orbital, as far as load_saved_analysis needs"""
+    def __init__(self, grp):
+        for name in ['E','I'] + sample_io.ANALYSIS_ARRAYS:
+            if name in grp:
+                setattr(self, name, grp[name][()])
+
+
+class LoadedSample:
+    def __init__(self, filepath, experiment_name):
+        self.load_path = filepath
+        self.experiment_name = experiment_name
+        with h5py.File(filepath, 'r') as f:
+            experiment = f[experiment_name]
+            self.element_scans = [k for k in experiment.keys() if sample_io.is_orbital_group(experiment[k])]
+            for orbital in self.element_scans:
+                self.__dict__[orbital] = LoadedSpectra(experiment[orbital])
+        sample_io.load_saved_analysis(self)
+
+
+def nan_equal(a, b):
+    return all([np.array_equal(a[name], b[name], equal_nan = a[name].dtype.kind == 'f') for name in a.dtype.names])
+
+
+def compare(saved, loaded):
+    """Differences between two spectra objects, as a list of strings"""
+    problems = []
+    for name in sample_io.ANALYSIS_ARRAYS:
+        if hasattr(saved, name) and not np.allclose(getattr(saved, name), getattr(loaded, name, np.nan)):
+            problems.append(name+' differs')
+    if hasattr(saved, 'params'):
+        if not isinstance(getattr(loaded, 'params', None), lm.Parameters):
+            return problems + ['params not loaded as Parameters']
+        if saved.params.valuesdict() != loaded.params.valuesdict():
+            problems.append('params differ')
+        if saved.mod.param_names != getattr(getattr(loaded, 'mod', None), 'param_names', None):
+            problems.append('mod differs')
+    if hasattr(saved, 'fit_results'):
+        fit_results = getattr(loaded, 'fit_results', None)
+        if not isinstance(fit_results, fitting.FitResultStore):
+            return problems + ['fit_results not loaded']
+        for name, table in saved.fit_results.tables().items():
+            if not nan_equal(table, fit_results.tables()[name]):
+                problems.append(name+' differs')
+        for i in np.flatnonzero(saved.fit_results.is_fitted()):
+            if not np.allclose(saved.fit_results[i].best_fit, fit_results[i].best_fit):
+                problems.append('rebuilt fit of spectrum %d differs' % i)
+    return problems
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Save an analysis through sample_io and check it loads back the same')
+    parser.add_argument('path', nargs = '?', help = 'sample .hdf5 file (default: a synthetic one)')
+    parser.add_argument('-e','--experiment', help = 'experiment name inside the sample file')
+    args = parser.parse_args(argv)
+    if (args.path is not None) and (args.experiment is None):
+        parser.error('--experiment is needed with a sample file')
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmpdir, 'roundtrip.hdf5')
+        if args.path is None:
+            experiment_name = 'roundtrip'
+            make_sample(filepath)
+            sample = sample_io.LazySample(filepath, experiment_name)
+            for orbital in sample.element_scans:
+                analyse(sample, orbital)
+        else:
+            experiment_name = args.experiment
+            shutil.copy(args.path, filepath)
+            sample = sample_io.LazySample(filepath, experiment_name)
+            for orbital in sample.element_scans:
+                changes.mark_all_dirty(sample.__dict__[orbital])
+        sample_io.save_spectra_batch(sample, sample.element_scans)
+
+        failed = 0
+        for how, loaded in [('lazy', sample_io.LazySample(filepath, experiment_name)), \
+            ('full', LoadedSample(filepath, experiment_name))]:
+            for orbital in sample.element_scans:
+                problems = compare(sample.__dict__[orbital], loaded.__dict__[orbital])
+                failed += len(problems)
+                print('  %-5s %-8s %s' % (how, orbital, 'ok' if problems == [] else ', '.join(problems)))
+            if how == 'lazy':
+                loaded.close()
+        sample.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
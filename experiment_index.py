@@ -0,0 +1,103 @@
+"""
+Catalog of the experiments in sample files, so listing them doesn't mean
+opening the files for writing.
+
+For every sample file looked at, the index keeps its experiments, their
+orbitals and the number of spectra in each, in a JSON file under ~/.xps_qt.
+An entry is only rebuilt when the file's modification time or size changes,
+and then the file is opened read only without locking (sample_io.open_readonly),
+so browsing the shared library never blocks someone saving into it.
+
+    index = experiment_index.default_index()
+    index.experiments('/path/sample.hdf5')           # ['surface_profile_1', ...]
+    index.orbitals('/path/sample.hdf5', 'surface_profile_1')   # {'Nb3d': 40, ...}
+"""
+import os
+import json
+import h5py
+
+import sample_io
+
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.xps_qt', 'experiment_index.json')
+
+
+def n_spectra(I):
+    return int(I.shape[0]) if I.ndim == 2 else 1
+
+
+def scan_file(filepath):
+    """{experiment: {'sample_name': ..., 'orbitals': {orbital: n_spectra}}} read from filepath"""
+    experiments = {}
+    with sample_io.open_readonly(filepath) as f:
+        for name, grp in f.items():
+            if not isinstance(grp, h5py.Group):
+                continue
+            orbitals = {orbital: n_spectra(grp[orbital]['I']) for orbital in grp.keys() \
+                if sample_io.is_orbital_group(grp[orbital])}
+            sample_name = sample_io.read_attr(grp, 'sample_name')
+            experiments[name] = {'sample_name': None if sample_name is None else str(sample_name), 'orbitals': orbitals}
+    return experiments
+
+
+class ExperimentIndex:
+    """The catalog, loaded from and saved to a JSON file"""
+
+    def __init__(self, path = INDEX_PATH):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.files = json.load(f)
+            except (OSError, ValueError) as e:
+                print('Experiment index at',path,'unreadable, starting a new one:',e)
+
+    def entry(self, filepath):
+        """Index entry of filepath, rescanned if the file changed, None if it doesn't exist"""
+        filepath = os.path.abspath(filepath)
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            self.files.pop(filepath, None)
+            return None
+        entry = self.files.get(filepath)
+        if (entry is None) or (entry['mtime'] != st.st_mtime_ns) or (entry['size'] != st.st_size):
+            entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'experiments': scan_file(filepath)}
+            self.files[filepath] = entry
+            self.save()
+        return entry
+
+    def experiments(self, filepath):
+        entry = self.entry(filepath)
+        return [] if entry is None else list(entry['experiments'].keys())
+
+    def orbitals(self, filepath, experiment):
+        """{orbital: number of spectra} of one experiment"""
+        entry = self.entry(filepath)
+        if (entry is None) or (experiment not in entry['experiments']):
+            return {}
+        return dict(entry['experiments'][experiment]['orbitals'])
+
+    def describe(self, filepath, experiment):
+        """One line summary of an experiment, e.g. 'Nb3d (40), O1s (40)'"""
+        return ', '.join(['%s (%d)' % (orbital, n) for orbital, n in self.orbitals(filepath, experiment).items()])
+
+    def save(self):
+        """Write the index, replacing the old one in one step. An unwritable home is not an error."""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            tmp_path = self.path + '.tmp%d' % os.getpid()
+            with open(tmp_path, 'w') as f:
+                json.dump(self.files, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('Could not save the experiment index:',e)
+
+
+_default = None
+
+def default_index():
+    global _default
+    if _default is None:
+        _default = ExperimentIndex()
+    return _default
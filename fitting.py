@@ -0,0 +1,316 @@
+"""
+Fitting helpers shared by the fit window and its background worker.
+
+These only touch lmfit/numpy so they can run off the Qt GUI thread.
+"""
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import lmfit as lm
+from lmfit.model import ModelResult
+from scipy.spatial import cKDTree
+sys.path.append("/Users/cassberk/code")
+import XPyS.autofit.autofit
+
+import bg_engine
+
+
+def fit_order(points, fit_in_reverse = False):
+    """Order the selected spectrum indices the same way spectra_obj.fit walks them"""
+    points = sorted(points)
+    if fit_in_reverse:
+        points = points[::-1]
+    return points
+
+
+def spectrum_coords(spectra_obj):
+    """Coordinates used to find neighbouring spectra, (n_spectra x 1) spectrum indices.
+
+    Spectra objects don't carry where on the sample each spectrum was taken, so
+    neighbours are the spectra next to each other in the scan.
+    """
+    return np.arange(len(spectra_obj.isub), dtype = float)[:,None]
+
+
+def neighbour_order(points, coords, fitted = ()):
+    """Fit order for warm starting, [(i, seed), ...].
+
+    seed is the closest spectrum that is fit by the time i is reached (one of
+    fitted or an earlier point), None when there is none yet. The next point
+    is always the remaining one closest to anything fit so far, so every
+    spectrum starts from a neighbour instead of the end of a long chain.
+    Memory stays linear in the number of points.
+    """
+    points = np.array(sorted(points), dtype = int)
+    X = coords[points]
+    dist = np.full(len(points), np.inf)
+    seed = np.full(len(points), -1)
+
+    fitted = np.setdiff1d(np.asarray(fitted, dtype = int), points)
+    if len(fitted) > 0:
+        d, nearest = cKDTree(coords[fitted]).query(X)
+        dist = d**2
+        seed = fitted[nearest]
+
+    remaining = np.ones(len(points), dtype = bool)
+    order = []
+    for step in range(len(points)):
+        candidates = np.where(remaining, dist, np.inf)
+        k = int(np.argmin(candidates)) if np.isfinite(candidates).any() else int(np.flatnonzero(remaining)[0])
+        order.append((int(points[k]), None if seed[k] < 0 else int(seed[k])))
+        remaining[k] = False
+
+        d = ((X - X[k])**2).sum(-1)
+        closer = remaining & (d < dist)
+        dist[closer] = d[closer]
+        seed[closer] = points[k]
+    return order
+
+
+def empty_fit_results(spectra_obj):
+    """Make sure spectra_obj.fit_results has one slot per spectrum, [] meaning not fit.
+
+    Results go into a FitResultStore for the current model. Results already there
+    are kept as long as the number of spectra and the parameters are the same.
+    """
+    fit_results = getattr(spectra_obj,'fit_results',None)
+    if not (isinstance(fit_results, FitResultStore) and (len(fit_results) == len(spectra_obj.isub)) \
+        and (fit_results.param_names == list(spectra_obj.params.keys()))):
+        store = FitResultStore(spectra_obj)
+        if (fit_results is not None) and (len(fit_results) == len(store)):
+            for i, result in enumerate(fit_results):
+                if (result != []) and (list(result.params.keys()) == store.param_names):
+                    store[i] = result
+        spectra_obj.fit_results = store
+    return spectra_obj.fit_results
+
+
+class RebuiltResult(ModelResult):
+    """ModelResult put back together from a FitResultStore's tables.
+
+    Only values, stderr and the statistics are kept, not the covariance or the
+    fitter, so what needs those raises a ValueError instead of failing somewhere
+    inside lmfit.
+    """
+
+    def eval_uncertainty(self, *args, **kwargs):
+        raise ValueError('The covariance of a stored fit is not kept, refit the spectrum for uncertainties')
+
+    def conf_interval(self, *args, **kwargs):
+        raise ValueError('Confidence intervals need the fit itself, refit the spectrum for them')
+
+
+class FitResultStore:
+    """Compact stand-in for the list of ModelResults in spectra_obj.fit_results.
+
+    Only the best fit values, stderr and fit statistics are kept, in structured
+    arrays with one row per spectrum and one field per parameter, so a parameter
+    across all spectra is just store.values[name]. Indexing still gives a
+    ModelResult (or [] for a spectrum that isn't fit), rebuilt from the row and
+    the spectrum's data when it is asked for.
+    """
+    STATS = [('fitted','?'),('success','?'),('nfev','i8'),('chisqr','f8'),('redchi','f8'),('walltime','f8')]
+
+    def __init__(self, spectra_obj):
+        self.spectra_obj = spectra_obj
+        self.mod = spectra_obj.mod
+        self.init_params = spectra_obj.params.copy()
+        self.param_names = list(self.init_params.keys())
+
+        n = len(spectra_obj.isub)
+        par_dtype = [(name,'f8') for name in self.param_names]
+        self.values = np.full(n, np.nan, dtype = par_dtype)
+        self.stderr = np.full(n, np.nan, dtype = par_dtype)
+        self.stats = np.zeros(n, dtype = self.STATS)
+        for name in ['chisqr','redchi','walltime']:
+            self.stats[name] = np.nan
+        self._shown = (None, None)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __setitem__(self, i, result):
+        self._shown = (None, None)
+        if result == []:
+            self.stats[i] = (False, False, 0, np.nan, np.nan, np.nan)
+            return
+        for name in self.param_names:
+            par = result.params[name]
+            self.values[name][i] = par.value
+            self.stderr[name][i] = np.nan if par.stderr is None else par.stderr
+        self.stats[i] = (True, result.success, result.nfev, result.chisqr, result.redchi, getattr(result,'walltime',np.nan))
+
+    def __getitem__(self, i):
+        if not self.stats['fitted'][i]:
+            return []
+        if self._shown[0] != i:
+            self._shown = (i, self.rebuild(i))
+        return self._shown[1]
+
+    def is_fitted(self):
+        return self.stats['fitted']
+
+    def params(self, i):
+        """Parameters of spectrum i with the stored values and stderr"""
+        pars = self.init_params.copy()
+        for name in self.param_names:
+            if pars[name].expr is None:
+                pars[name].value = self.values[name][i]
+            pars[name].stderr = None if np.isnan(self.stderr[name][i]) else self.stderr[name][i]
+        pars.update_constraints()
+        return pars
+
+    def rebuild(self, i):
+        """ModelResult for spectrum i, without refitting"""
+        esub = self.spectra_obj.esub
+        data = self.spectra_obj.isub[i]
+        result = RebuiltResult(self.mod, self.init_params.copy(), data = data, fcn_kws = {'x': esub})
+        result.params = self.params(i)
+        result.userkws = {'x': esub}
+        result.init_fit = self.mod.eval(self.init_params, x = esub)
+        result.best_fit = self.mod.eval(result.params, x = esub)
+        result.residual = result.best_fit - data
+        result.success, result.nfev = bool(self.stats['success'][i]), int(self.stats['nfev'][i])
+        result.chisqr, result.redchi = float(self.stats['chisqr'][i]), float(self.stats['redchi'][i])
+        result.ndata = len(data)
+        result.var_names = [name for name, par in result.params.items() if par.vary and (par.expr is None)]
+        result.nvarys = len(result.var_names)
+        result.nfree = result.ndata - result.nvarys
+        result.init_values = {name: self.init_params[name].value for name in result.var_names}
+        result.covar = None
+        result.errorbars = not np.isnan(self.stderr[i].tolist()).all()
+        return result
+
+    def summary(self, rows):
+        """One line of convergence statistics over the fitted spectra in rows"""
+        stats = self.stats[np.asarray(rows, dtype = int)]
+        stats = stats[stats['fitted']]
+        if len(stats) == 0:
+            return 'No spectra fit'
+        return '%d fit, %d failed to converge: %d function evaluations (%.1f per fit), %.1f s, median reduced chi-square %.3g' \
+            % (len(stats), np.sum(~stats['success']), np.sum(stats['nfev']), np.mean(stats['nfev']), \
+            np.nansum(stats['walltime']), np.nanmedian(stats['redchi']))
+
+    def tables(self):
+        """The arrays to save, keyed by dataset name"""
+        return {'fit_values': self.values, 'fit_stderr': self.stderr, 'fit_stats': self.stats}
+
+    @classmethod
+    def from_tables(cls, spectra_obj, tables):
+        """Store for spectra_obj's model filled from saved tables (as tables() gives them).
+
+        Tables saved for other parameters or another number of spectra can't be
+        matched to this model, the store is left empty then.
+        """
+        store = cls(spectra_obj)
+        values = tables['fit_values']
+        if (list(values.dtype.names) != store.param_names) or (len(values) != len(store)):
+            print('Saved fit results of',getattr(spectra_obj,'orbital',''),'do not match its model, not loaded')
+            return store
+        for name, table in [('fit_values', store.values), ('fit_stderr', store.stderr), ('fit_stats', store.stats)]:
+            for field in table.dtype.names:
+                if field in tables[name].dtype.names:
+                    table[field] = tables[name][field]
+        return store
+
+
+def seed_params(spectra_obj, i, autofit = False, start = None):
+    """Starting parameters for spectrum i.
+
+    start is the fitted parameters of another spectrum to chain off (the last
+    fit, or the nearest neighbour when warm starting), otherwise every spectrum
+    starts from spectra_obj.params.
+    """
+    if start is not None:
+        pars = start.copy()
+    else:
+        pars = spectra_obj.params.copy()
+
+    if autofit:
+        apply_autofit(pars, spectra_obj.esub, spectra_obj.isub[i], spectra_obj.orbital)
+    return pars
+
+
+def autofit_guess(esub, intensity, orbital):
+    """Autofit peak guesses for one spectrum as {par: value}"""
+    af = XPyS.autofit.autofit.autofit(esub,intensity,orbital)
+    return dict(af.guess_pars)
+
+
+def autofit_key(spectra_obj, i):
+    """What an autofit guess depends on: the orbital, the spectrum, the model and
+    the background subtraction it was guessed from"""
+    return (spectra_obj.orbital, i, spectra_obj.mod.name, bg_engine.bg_version(spectra_obj))
+
+
+def apply_autofit(pars, esub, intensity, orbital):
+    """Overwrite pars with the autofit peak guesses for one spectrum"""
+    for par, value in autofit_guess(esub, intensity, orbital).items():
+        pars[par].value = value
+    return pars
+
+
+def fit_spectrum(mod, pars, esub, intensity):
+    """Fit a single spectrum against esub, the time taken is kept in result.walltime"""
+    t0 = time.perf_counter()
+    result = mod.fit(intensity, pars, x = esub)
+    result.walltime = time.perf_counter() - t0
+    return result
+
+
+"""Process pool fitting. Every spectrum is seeded from the same params so the
+points are independent and can be spread over all cores. Composite models and
+ModelResults don't survive plain pickle, so they cross the process boundary
+with lmfit's own dumps/loads."""
+_pool_state = {}
+
+def _init_fit_process(mod_dump, params_dump, esub, orbital, autofit):
+    _pool_state['mod'] = lm.Model(lambda x: x).loads(mod_dump)
+    _pool_state['params'] = lm.Parameters().loads(params_dump)
+    _pool_state['esub'] = esub
+    _pool_state['orbital'] = orbital
+    _pool_state['autofit'] = autofit
+
+def _fit_in_process(i, intensity):
+    pars = _pool_state['params'].copy()
+    if _pool_state['autofit']:
+        apply_autofit(pars, _pool_state['esub'], intensity, _pool_state['orbital'])
+    result = fit_spectrum(_pool_state['mod'], pars, _pool_state['esub'], intensity)
+    return i, result.dumps(), result.walltime
+
+
+def iter_fit_parallel(spectra_obj, points, autofit = False, max_workers = None, cancelled = None):
+    """Fit the spectrum indices in points across a ProcessPoolExecutor of spawned processes.
+
+    The model and params are serialized once and loaded once per process. Yields
+    (i, result) as fits complete, where result is the ModelResult or the exception
+    raised while fitting spectrum i. cancelled is an optional callable checked
+    between results; once it returns True the pending fits are dropped.
+    """
+    initargs = (spectra_obj.mod.dumps(), spectra_obj.params.dumps(), spectra_obj.esub, \
+        getattr(spectra_obj,'orbital',None), autofit)
+
+    # Spawned, not forked: this runs on a QThread of the GUI, and a forked child could
+    # inherit a lock some other thread (autofit's QThreadPool, h5py) was holding
+    executor = ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context('spawn'), \
+        initializer = _init_fit_process, initargs = initargs)
+    try:
+        futures = {executor.submit(_fit_in_process, i, spectra_obj.isub[i]): i for i in points}
+        for future in as_completed(futures):
+            try:
+                i, result_dump, walltime = future.result()
+                result = ModelResult(spectra_obj.mod, spectra_obj.params.copy()).loads(result_dump)
+                result.walltime = walltime
+                yield i, result
+            except Exception as e:
+                yield futures[future], e
+            if (cancelled is not None) and cancelled():
+                break
+    finally:
+        executor.shutdown(wait = False, cancel_futures = True)
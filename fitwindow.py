@@ -1,4 +1,5 @@
 import sys, os, random
+import operator
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
@@ -19,10 +20,27 @@ from XPyS.gui_element_dicts import *
 from copy import deepcopy as dc
 
 from parameter_gui import ParameterWindow
+from trendwindow import TrendWindow
+from spectra_select import SpectraSelector
 import data_tree
+import fitting
+import changes
+import bg_engine
 
 from IPython import embed as shell
 
+def fill_verts(x, y):
+    """Polygon vertices of fill_between(x, y) down to zero"""
+    return np.concatenate([np.column_stack([x, y]), np.column_stack([x[::-1], np.zeros_like(x)])])
+
+
+def is_additive(mod):
+    """True if the model is a plain sum of its components, so eval == sum(eval_components)"""
+    if isinstance(mod, lm.model.CompositeModel):
+        return (mod.op is operator.add) and is_additive(mod.left) and is_additive(mod.right)
+    return True
+
+
 class OptionListWindow(QWidget):
 
     def __init__(self,files):
@@ -53,12 +71,22 @@ class OptionListWindow(QWidget):
         self.show()
 
 class QParameter(QWidget,lm.parameter.Parameter):
+    """Parameter of spectra_obj.params that signals its changes.
+
+    Every change is marked on owner (the spectra object) for saving, whether it
+    comes from the fit window, a linked parameter or the shell.
+    """
     valueChanged = pyqtSignal(object)
 
-    def __init__(self, parameter=None):
+    def __init__(self, parameter=None, owner=None):
         super(QParameter, self).__init__(name = parameter.name, value=parameter.value, vary=parameter.vary, min=parameter.min, max=parameter.max,
                  expr=parameter.expr, brute_step=parameter.brute_step, user_data=parameter.user_data)
         self._par = parameter
+        self._owner = owner
+
+    def mark_changed(self):
+        if getattr(self,'_owner',None) is not None:
+            changes.mark_dirty(self._owner, 'params')
 
     @property
     def value(self):
@@ -67,6 +95,7 @@ class QParameter(QWidget,lm.parameter.Parameter):
     @value.setter
     def value(self, val):
         self._par.set(value = val)
+        self.mark_changed()
         self.valueChanged.emit(val)
 
     @property
@@ -76,12 +105,14 @@ class QParameter(QWidget,lm.parameter.Parameter):
     @expr.setter
     def expr(self, exp):
         self._par.set(expr = exp)
+        self.mark_changed()
         self.valueChanged.emit(exp)
 
     def slotvalue(self,v):
         if v > self._par.min:
             v = self._par.min
         self._par.set(value = v)
+        self.mark_changed()
 
 
     # @property
@@ -112,6 +143,120 @@ class QParameter(QWidget,lm.parameter.Parameter):
     #     self.valueChanged.emit(v)
 
 
+class FitWorker(QObject):
+    """Fits the chosen spectra off the GUI thread.
+
+    Each finished fit is written into spectra_obj.fit_results[i] and announced
+    with spectrumFitted so the window can show it straight away.
+    """
+    progress = pyqtSignal(int,int)
+    spectrumFitted = pyqtSignal(int)
+    finished = pyqtSignal()
+
+    def __init__(self, spectra_obj, fitlist, autofit = False, fit_in_reverse = False, update_with_prev_pars = False, parallel = False, \
+        warm_start = False):
+        super().__init__()
+        self.spectra_obj = spectra_obj
+        self.fitlist = fitlist
+        self.autofit = autofit
+        self.fit_in_reverse = fit_in_reverse
+        self.update_with_prev_pars = update_with_prev_pars
+        self.parallel = parallel
+        self.warm_start = warm_start
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        # finished always goes out, the window re-enables Fit and cleans up the thread on it
+        try:
+            # Chained fits depend on the previous result so they always run in sequence
+            if self.warm_start:
+                self.run_sequential(self.neighbour_order())
+            elif self.parallel and not (self.update_with_prev_pars or self.fit_in_reverse):
+                self.run_parallel()
+            else:
+                self.run_sequential(self.chain_order())
+        except Exception as e:
+            print('Fitting stopped:',e)
+        finally:
+            self.finished.emit()
+
+    def run_parallel(self):
+        fit_results = fitting.empty_fit_results(self.spectra_obj)
+        n = 0
+        for i, result in fitting.iter_fit_parallel(self.spectra_obj, self.fitlist, autofit = self.autofit, \
+            cancelled = lambda: self._cancelled):
+            n += 1
+            if isinstance(result, Exception):
+                print('Fit failed for spectrum',i,':',result)
+            else:
+                fit_results[i] = result
+                changes.mark_dirty(self.spectra_obj, 'fit_results', i)
+                self.spectrumFitted.emit(i)
+            self.progress.emit(n,len(self.fitlist))
+
+    def chain_order(self):
+        """[(i, seed), ...] walking the points in one direction, seeded off the previous one
+        with update_with_prev_pars"""
+        points = fitting.fit_order(self.fitlist, fit_in_reverse = self.fit_in_reverse)
+        if not self.update_with_prev_pars:
+            return [(i, None) for i in points]
+        return list(zip(points, [None] + points[:-1]))
+
+    def neighbour_order(self):
+        """[(i, seed), ...] with every point seeded off its nearest fitted neighbour"""
+        fit_results = fitting.empty_fit_results(self.spectra_obj)
+        fitted = np.flatnonzero(fit_results.is_fitted() & fit_results.stats['success'])
+        return fitting.neighbour_order(self.fitlist, fitting.spectrum_coords(self.spectra_obj), fitted = fitted)
+
+    def run_sequential(self, order):
+        fit_results = fitting.empty_fit_results(self.spectra_obj)
+
+        for n, (i, seed) in enumerate(order):
+            if self._cancelled:
+                break
+            # A neighbour that failed or didn't converge would only pass its bad fit on
+            start = None
+            if (seed is not None) and fit_results.stats['fitted'][seed] and fit_results.stats['success'][seed]:
+                start = fit_results.params(seed)
+            try:
+                pars = fitting.seed_params(self.spectra_obj, i, autofit = self.autofit, start = start)
+                result = fitting.fit_spectrum(self.spectra_obj.mod, pars, self.spectra_obj.esub, self.spectra_obj.isub[i])
+            except Exception as e:
+                print('Fit failed for spectrum',i,':',e)
+            else:
+                fit_results[i] = result
+                changes.mark_dirty(self.spectra_obj, 'fit_results', i)
+                self.spectrumFitted.emit(i)
+            self.progress.emit(n+1,len(order))
+
+
+class AutofitSignals(QObject):
+    guessed = pyqtSignal(object, object)
+
+
+class AutofitJob(QRunnable):
+    """Autofit guesses for one spectrum on a thread pool, sent back with guessed(key, guess)"""
+
+    def __init__(self, key, esub, intensity, orbital, signals):
+        super().__init__()
+        self.key = key
+        self.esub = esub
+        self.intensity = intensity
+        self.orbital = orbital
+        self.signals = signals
+
+    def run(self):
+        try:
+            guess = fitting.autofit_guess(self.esub, self.intensity, self.orbital)
+        except Exception as e:
+            print('Autofit failed for spectrum',self.key[1],':',e)
+            guess = None
+        self.signals.guessed.emit(self.key, guess)
+
+
 class FitViewWindow(QMainWindow):
     
     def __init__(self, parent = None, spectra_obj=None):
@@ -119,14 +264,36 @@ class FitViewWindow(QMainWindow):
 
         self.setWindowTitle('An lmfit Experience')
         self.paramsWindow = None
+        self.trendWindow = None
         self.sampletreeWindow = None
 
+        # Autofit guesses by fitting.autofit_key, worked out ahead for the neighbouring spectra
+        self.autofit_guesses = {}
+        self.autofit_pending = set()
+        self.autofit_prefetch = 5
+        self.autofit_pool = QThreadPool(self)
+        self.autofit_pool.setMaxThreadCount(2)
+        self.autofit_signals = AutofitSignals()
+        self.autofit_signals.guessed.connect(self.autofit_guessed)
+        self.fit_thread = None
+        self.background = None
+        self.model_line = None
+        self.comp_fills = []
+        self._components_key = None
+        self._components = None
+
+        # Coalesces parameter changes into one redraw per ~60 Hz frame
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(16)
+        self.redraw_timer.timeout.connect(self.update_model_artists)
+
         # self.mod = None
         self.spectra_obj = spectra_obj
         # shell()
         # self.params = {}
         if hasattr(self.spectra_obj,'params'):
-            self.params = {par:QParameter(parameter = self.spectra_obj.params[par]) for par in spectra_obj.params.keys()}
+            self.params = {par:QParameter(parameter = self.spectra_obj.params[par], owner = self.spectra_obj) for par in spectra_obj.params.keys()}
         # self.params = ParSignal(parameter = spectra_obj.params['Nb_52_amplitude'])
         # shell()
         # print(self.spectra_obj.mod)
@@ -152,7 +319,14 @@ class FitViewWindow(QMainWindow):
             path += file_choices[-4:].encode('utf-8')
         print(path)
         if path:
+            # Animated artists are left out of print_figure, draw them normally for the save
+            for artist in [self.model_line] + self.comp_fills:
+                if artist is not None:
+                    artist.set_animated(False)
             self.canvas.print_figure(path.decode(), dpi=self.dpi)
+            for artist in [self.model_line] + self.comp_fills:
+                if artist is not None:
+                    artist.set_animated(True)
             self.statusBar().showMessage('Saved to %s' % path, 2000)
 
 
@@ -186,62 +360,137 @@ class FitViewWindow(QMainWindow):
         
         QMessageBox.information(self, "Click!", msg)
     
+    def plot_params(self):
+        """Params the model curves are drawn from, None if there is nothing to draw"""
+        if not self.fit_result_cb.isChecked():
+            if hasattr(self.spectra_obj,'params'):
+                return self.params
+        elif hasattr(self.spectra_obj,'fit_results') and (self.spectra_obj.fit_results[self.spectra_plot_box.value()] != []):
+            return self.spectra_obj.fit_results[self.spectra_plot_box.value()].params
+        return None
+
+    def eval_components(self, pars):
+        """mod.eval_components, evaluated once per parameter state.
+
+        The cache is keyed on the parameter values so the model line and every
+        pair fill of a redraw share a single evaluation of the composite model.
+        """
+        key = (id(self.spectra_obj.mod), id(self.spectra_obj.esub), tuple((name, pars[name].value) for name in pars.keys()))
+        if key != self._components_key:
+            self._components = self.spectra_obj.mod.eval_components(params = pars,x = self.spectra_obj.esub)
+            self._components_key = key
+        return self._components
+
+    def model_curves(self, pars):
+        """Full model and the summed component curve of each pair in pairlist"""
+        components = self.eval_components(pars)
+        if is_additive(self.spectra_obj.mod):
+            model = sum(components.values())
+        else:
+            model = self.spectra_obj.mod.eval(pars, x = self.spectra_obj.esub)
+        pair_sums = [sum([components[comp] for comp in pairs]) for pairs in self.spectra_obj.pairlist]
+        return model, pair_sums
+
     def update_plot(self):
         """ Redraws the figure
-        """
 
-        # clear the axes and redraw the plot anew
-        #
-        # print(self.spectra_plot_box.value())
-        # print(self.fit_result_cb.value())
-        # print(self.fit_result_cb.isChecked())
+        The data line is part of the cached background. The model line and
+        component fills are animated artists that update_model_artists
+        blits on top of it when only the parameters change.
+        """
         self.axes.cla()        
+        self.background = None
+        self.model_line = None
+        self.comp_fills = []
 
         self.axes.grid(self.grid_cb.isChecked())
-        
-
-        if not self.fit_result_cb.isChecked():
-            self.axes.plot(self.spectra_obj.esub, self.spectra_obj.isub[self.spectra_plot_box.value()],'o')
-            if hasattr(self.spectra_obj,'params'):
-                self.axes.plot(self.spectra_obj.esub, self.spectra_obj.mod.eval(self.params, x = self.spectra_obj.esub))
-                for pairs in enumerate(self.spectra_obj.pairlist):
-                    self.axes.fill_between(self.spectra_obj.esub,\
-                        sum([self.spectra_obj.mod.eval_components(params = self.params,x = self.spectra_obj.esub)[comp] for comp in pairs[1]]), \
-                            color = element_color[pairs[1][0]],alpha=0.3)
-
-        elif self.fit_result_cb.isChecked():
-            self.axes.plot(self.spectra_obj.esub, self.spectra_obj.isub[self.spectra_plot_box.value()],'o')
-            if hasattr(self.spectra_obj,'fit_results') and (self.spectra_obj.fit_results[self.spectra_plot_box.value()] != []):
-                self.axes.plot(self.spectra_obj.esub, self.spectra_obj.mod.eval(self.spectra_obj.fit_results[self.spectra_plot_box.value()].params, x = self.spectra_obj.esub))
-                for pairs in enumerate(self.spectra_obj.pairlist):
-                    self.axes.fill_between(self.spectra_obj.esub,\
-                        sum([self.spectra_obj.mod.eval_components(params = self.spectra_obj.fit_results[self.spectra_plot_box.value()].params,x = self.spectra_obj.esub)[comp] for comp in pairs[1]]), \
-                            color = element_color[pairs[1][0]],alpha=0.3)
-        
 
+        self.data_line, = self.axes.plot(self.spectra_obj.esub, self.spectra_obj.isub[self.spectra_plot_box.value()],'o')
+        pars = self.plot_params()
+        if pars is not None:
+            model, pair_sums = self.model_curves(pars)
+            self.model_line, = self.axes.plot(self.spectra_obj.esub, model, animated = True)
+            for pairs, pair_sum in zip(self.spectra_obj.pairlist, pair_sums):
+                self.comp_fills.append(self.axes.fill_between(self.spectra_obj.esub, pair_sum, \
+                    color = element_color[pairs[0]],alpha=0.3, animated = True))
 
         self.axes.set_xlabel('Binding Energy (eV)',fontsize=24)
         self.axes.set_ylabel('Counts/sec',fontsize=24)
-        self.axes.set_xlim(np.max(self.spectra_obj.esub),np.min(self.spectra_obj.esub))
+        energy = bg_engine.energy_index(self.spectra_obj, 'esub')
+        self.axes.set_xlim(energy.Emax,energy.Emin)
         self.axes.tick_params(labelsize=20)
         self.fig.tight_layout()
         self.canvas.draw()
 
+    def on_draw(self, event):
+        """Every full draw (ours, zoom, pan, resize) refreshes the blit background"""
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_model_artists()
+
+    def draw_model_artists(self):
+        for artist in [self.model_line] + self.comp_fills:
+            if artist is not None:
+                self.axes.draw_artist(artist)
 
+    def update_model_artists(self):
+        """Fast redraw after a parameter change.
+
+        Only the y-data of the retained model artists is updated and they are
+        blitted over the cached background, no axes.cla() or full canvas draw.
+        """
+        if self.fit_result_cb.isChecked():
+            return
+        if (self.model_line is None) or (self.background is None):
+            self.update_plot()
+            return
+
+        model, pair_sums = self.model_curves(self.params)
+        self.model_line.set_ydata(model)
+        for fill, pair_sum in zip(self.comp_fills, pair_sums):
+            fill.set_verts([fill_verts(self.spectra_obj.esub, pair_sum)])
+
+        self.canvas.restore_region(self.background)
+        self.draw_model_artists()
+        self.canvas.blit(self.axes.bbox)
 
     def autofit(self):
         sender = self.sender()
+        i = self.spectra_plot_box.value()
         if sender.objectName() == 'afButton':
-            self.spectra_obj.autofit = XPyS.autofit.autofit.autofit(self.spectra_obj.esub,self.spectra_obj.isub[self.spectra_plot_box.value()],self.spectra_obj.orbital)
-
-        if self.autofit_cb.isChecked():
-            if not hasattr(self.spectra_obj,'autofit'):
-                self.spectra_obj.autofit = XPyS.autofit.autofit.autofit(self.spectra_obj.esub,self.spectra_obj.isub[self.spectra_plot_box.value()],self.spectra_obj.orbital)
-            elif hasattr(self,'autofit'):
-                self.spectra_obj.autofit.guess_params(energy = self.spectra_obj.esub,intensity = self.spectra_obj.isub[self.spectra_plot_box.value()])
-            for par in self.spectra_obj.autofit.guess_pars.keys():
-                self.spectra_obj.params[par].value = self.spectra_obj.autofit.guess_pars[par]
-                print(par,self.spectra_obj.autofit.guess_pars[par])
+            self.spectra_obj.autofit = XPyS.autofit.autofit.autofit(self.spectra_obj.esub,self.spectra_obj.isub[i],self.spectra_obj.orbital)
+            if hasattr(self.spectra_obj,'mod'):
+                self.autofit_guesses[fitting.autofit_key(self.spectra_obj, i)] = dict(self.spectra_obj.autofit.guess_pars)
+
+        if self.autofit_cb.isChecked() and hasattr(self.spectra_obj,'mod'):
+            # Scrolling never waits on autofit, the guess is applied when it comes back
+            key = fitting.autofit_key(self.spectra_obj, i)
+            if key in self.autofit_guesses:
+                self.apply_autofit_guess(self.autofit_guesses[key], redraw = sender is not self.spectra_plot_box)
+            for j in [i] + [i + d*k for k in range(1,self.autofit_prefetch+1) for d in (1,-1)]:
+                if 0 <= j < len(self.spectra_obj.isub):
+                    self.request_autofit(j)
+
+    def request_autofit(self, i):
+        key = fitting.autofit_key(self.spectra_obj, i)
+        if (key in self.autofit_guesses) or (key in self.autofit_pending):
+            return
+        self.autofit_pending.add(key)
+        self.autofit_pool.start(AutofitJob(key, self.spectra_obj.esub, self.spectra_obj.isub[i], \
+            self.spectra_obj.orbital, self.autofit_signals))
+
+    def autofit_guessed(self, key, guess):
+        self.autofit_pending.discard(key)
+        if guess is None:
+            return
+        self.autofit_guesses[key] = guess
+        if self.autofit_cb.isChecked() and (key == fitting.autofit_key(self.spectra_obj, self.spectra_plot_box.value())):
+            self.apply_autofit_guess(guess)
+
+    def apply_autofit_guess(self, guess, redraw = True):
+        for par, value in guess.items():
+            self.spectra_obj.params[par].value = value
+        changes.mark_dirty(self.spectra_obj, 'params')
+        if redraw:
             self.update_plot()
 
     # self.autofit = XPyS.autofit.autofit.autofit(self.spectra_object.esub,self.spectra_object.isub[specnum[0]],self.spectra_object.orbital)
@@ -251,6 +500,16 @@ class FitViewWindow(QMainWindow):
         self.sampletreeWindow.tree.itemChanged[QTreeWidgetItem, int].connect(self.plot_tree_choices)
         
 
+    def show_trend_window(self):
+        if not hasattr(self.spectra_obj,'mod'):
+            print('No Model Loaded')
+            return
+        if self.trendWindow is None:
+            self.trendWindow = TrendWindow(spectra_obj = self.spectra_obj)
+            self.trendWindow.spectrumPicked.connect(self.spectra_plot_box.setValue)
+        self.trendWindow.show()
+        self.trendWindow.raise_()
+
     """Here we build the window to interactively change the parameters"""
     def show_params_window(self):
         if not hasattr(self.spectra_obj,'mod'):
@@ -263,6 +522,7 @@ class FitViewWindow(QMainWindow):
 
             self.paramsWindow.show()
             self.connect_parameters()
+            self.paramsWindow.widgetsBuilt.connect(self.connect_parameters)
 
         else:
             self.paramsWindow.close()
@@ -270,8 +530,9 @@ class FitViewWindow(QMainWindow):
             # self.disconnect_parameter()
 
   
-    def connect_parameters(self):
-        for par in self.paramsWindow.paramwidgets.keys():
+    def connect_parameters(self, pars = None):
+        """Wire up the parameter widgets built so far, or just the ones in pars"""
+        for par in (self.paramsWindow.paramwidgets.keys() if pars is None else pars):
 
             # Connect QParameter and Slider
             self.paramsWindow.paramwidgets[par].slider.valueChanged.connect(self.update_Qpar_val_from_slider)
@@ -293,53 +554,77 @@ class FitViewWindow(QMainWindow):
         M = self.paramsWindow.paramwidgets[sender.objectName()].ctrl_limits_max
         pval = np.round(100*(m + v*(M - m)/n))/100
 
-        self.params[sender.objectName()].set(value = pval )
-        self.update_plot()
+        if self.params[sender.objectName()].value != pval:
+            self.params[sender.objectName()].set(value = pval )
+            self.params_changed()
 
     def update_Qpar_val_from_numbox(self,v):
         sender = self.sender()
         nval = np.round(100*v)/100
 
-        self.params[sender.objectName()].set(value = nval )
-        self.update_plot()
+        if self.params[sender.objectName()].value != nval:
+            self.params[sender.objectName()].set(value = nval )
+            self.params_changed()
 
+    """The slider and numbox follow the QParameter with their signals blocked,
+    otherwise every change echoes back through update_Qpar_val_from_* """
     def update_slider(self, v):
         sender = self.sender()
+        if (self.paramsWindow is None) or (sender.name not in self.paramsWindow.paramwidgets):
+            return
         m = self.paramsWindow.paramwidgets[sender.name].ctrl_limits_min
         M = self.paramsWindow.paramwidgets[sender.name].ctrl_limits_max
         slideval = np.round( (v - m)/( (M-m)/self.paramsWindow.paramwidgets[sender.name].N ) )
-        self.paramsWindow.paramwidgets[sender.name].slider.setValue(slideval)
-        # self.update_plot()
+        slider = self.paramsWindow.paramwidgets[sender.name].slider
+        slider.blockSignals(True)
+        slider.setValue(int(slideval))
+        slider.blockSignals(False)
 
     def update_numbox(self, v):
         sender = self.sender()
+        if (self.paramsWindow is None) or (sender.name not in self.paramsWindow.paramwidgets):
+            return
         parval = np.round(100*v)/100
-        self.paramsWindow.paramwidgets[sender.name].numbox.setValue(parval)
+        numbox = self.paramsWindow.paramwidgets[sender.name].numbox
+        numbox.blockSignals(True)
+        numbox.setValue(parval)
+        numbox.blockSignals(False)
+
+    def schedule_redraw(self):
+        """Mark the model artists dirty, they are redrawn at most once per frame"""
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+
+    def params_changed(self):
+        changes.mark_dirty(self.spectra_obj, 'params')
+        self.schedule_redraw()
 
     def update_min(self,minimum):
         sender = self.sender()
         # shell()
         self.spectra_obj.params[sender.objectName()].min = minimum
         self.params[sender.objectName()].min = minimum
+        changes.mark_dirty(self.spectra_obj, 'params')
 
     def update_max(self,maximum):
         sender = self.sender()
         # shell()
         self.spectra_obj.params[sender.objectName()].max = maximum 
         self.params[sender.objectName()].max = maximum 
+        changes.mark_dirty(self.spectra_obj, 'params')
 
     def update_expr(self,expression):
         sender = self.sender()
         self.spectra_obj.params[sender.objectName()].set(expr = expression )
         self.params[sender.objectName()].set(expr = expression )
-        self.update_plot()
+        self.params_changed()
 
     def update_vary(self,var):
         sender = self.sender()
         print(var)
         self.spectra_obj.params[sender.title()].set(vary = var)
         self.params[sender.title()].set(vary = var)
-        self.update_plot()
+        self.params_changed()
         # print(vary)
 
 
@@ -352,8 +637,11 @@ class FitViewWindow(QMainWindow):
         self.spectra_obj.params = ldd_mod[1]
         self.spectra_obj.pairlist = ldd_mod[2]
         self.spectra_obj.element_ctrl = ldd_mod[3]
-        self.params = {par:QParameter(parameter = self.spectra_obj.params[par]) for par in self.spectra_obj.params.keys()}
+        changes.mark_dirty(self.spectra_obj, 'params')
+        self.params = {par:QParameter(parameter = self.spectra_obj.params[par], owner = self.spectra_obj) for par in self.spectra_obj.params.keys()}
         self.ModelListWindow.close()
+        if self.trendWindow is not None:
+            self.trendWindow.model_changed()
 
     def choose_model(self):
         self.ModelListWindow = OptionListWindow(XPyS.models.model_list(startpath = os.path.join('/Users/cassberk/code/XPyS/saved_models',self.spectra_obj.orbital)))
@@ -363,25 +651,89 @@ class FitViewWindow(QMainWindow):
 
     """Here we build the window to fit the spectra"""
     def fit_spectra(self):
+        if self.fit_thread is not None:
+            print('Fit already running')
+            return
 
-        fitlist = []
-        iterator = QTreeWidgetItemIterator(self.spectra_tree, QTreeWidgetItemIterator.Checked)
-        while iterator.value():
-            item = iterator.value()
-            if item.text(0) != 'All':
-                fitlist.append(int(item.text(0)))
-            iterator += 1
-        print(fitlist)
+        if not hasattr(self.spectra_obj,'mod'):
+            self.statusBar().showMessage('Load a model before fitting')
+            return
+        fitlist = self.spectra_select.selected().tolist()
+        print(len(fitlist),'spectra to fit')
+        if fitlist == []:
+            return
 
+        self.fit_worker = FitWorker(self.spectra_obj, fitlist, autofit = self.autofit_cb.isChecked(), \
+            fit_in_reverse = self.fit_in_reverse_cb.isChecked(), update_with_prev_pars = self.update_prev_pars_cb.isChecked(), \
+            parallel = self.parallel_fit_cb.isChecked(), warm_start = self.warm_start_cb.isChecked())
+        self.fit_thread = QThread(self)
+        self.fit_worker.moveToThread(self.fit_thread)
+
+        self.fit_thread.started.connect(self.fit_worker.run)
+        self.fit_worker.progress.connect(self.update_fit_progress)
+        self.fit_worker.spectrumFitted.connect(self.show_fitted_spectrum)
+        self.fit_worker.finished.connect(self.fit_thread.quit)
+        self.fit_thread.finished.connect(self.fit_finished)
+
+        self.fitlist = fitlist
+        self.fit_progress.setMaximum(len(fitlist))
+        self.fit_progress.setValue(0)
+        self.fit_button.setEnabled(False)
+        self.cancel_fit_button.setEnabled(True)
+        self.fit_thread.start()
+
+    def cancel_fit(self):
+        if self.fit_thread is not None:
+            self.fit_worker.cancel()
+            self.statusBar().showMessage('Cancelling fit...')
+
+    def update_fit_progress(self, n, total):
+        self.fit_progress.setValue(n)
+        self.statusBar().showMessage('Fit %d of %d' % (n,total))
+
+    def show_fitted_spectrum(self, i):
+        if self.trendWindow is not None:
+            self.trendWindow.spectrum_fitted(i)
+        if self.follow_fit_cb.isChecked() and (self.spectra_plot_box.value() != i):
+            # Don't let the jump re-run autofit on the live params mid fit
+            self.spectra_plot_box.blockSignals(True)
+            self.spectra_plot_box.setValue(i)
+            self.spectra_plot_box.blockSignals(False)
+            self.update_plot()
+        elif self.spectra_plot_box.value() == i:
+            self.update_plot()
 
-        self.spectra_obj.fit(specific_points = fitlist,autofit = self.autofit_cb.isChecked(), fit_in_reverse = self.fit_in_reverse_cb.isChecked(), \
-            update_with_prev_pars = self.update_prev_pars_cb.isChecked(),plotflag = False, track = False)
+    def fit_finished(self):
+        self.fit_thread.deleteLater()
+        self.fit_worker.deleteLater()
+        self.fit_thread = None
+        self.fit_worker = None
+        self.fit_button.setEnabled(True)
+        self.cancel_fit_button.setEnabled(False)
+        fit_results = getattr(self.spectra_obj,'fit_results',None)
+        if isinstance(fit_results, fitting.FitResultStore):
+            summary = fit_results.summary(self.fitlist)
+        else:
+            # The worker failed before it got to the fits, what went wrong is printed
+            summary = 'Fit failed, see the console'
+        print(summary)
+        self.statusBar().showMessage(summary)
         self.update_plot()
 
+    def closeEvent(self, event):
+        if self.fit_thread is not None:
+            self.fit_worker.cancel()
+            self.fit_thread.quit()
+            self.fit_thread.wait()
+        self.autofit_pool.clear()
+        self.autofit_pool.waitForDone()
+        event.accept()
+
     def fit_result_to_params(self):
 
         self.spectra_obj.params = self.spectra_obj.fit_results[self.spectra_plot_box.value()].params.copy() 
-        self.params = {par:QParameter(parameter = self.spectra_obj.params[par]) for par in self.spectra_obj.params.keys()}
+        changes.mark_dirty(self.spectra_obj, 'params')
+        self.params = {par:QParameter(parameter = self.spectra_obj.params[par], owner = self.spectra_obj) for par in self.spectra_obj.params.keys()}
 
 
 
@@ -406,6 +758,7 @@ class FitViewWindow(QMainWindow):
         
         """Bind the 'pick' event for clicking on one of the bars"""
         self.canvas.mpl_connect('pick_event', self.on_pick)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
         
         """Create the navigation toolbar, tied to the canvas"""
         self.mpl_toolbar = NavigationToolbar(self.canvas, self.main_frame)
@@ -424,6 +777,17 @@ class FitViewWindow(QMainWindow):
         self.fit_button = QPushButton("Fit")
         self.fit_button.clicked.connect(self.fit_spectra)
 
+        self.cancel_fit_button = QPushButton("Cancel Fit")
+        self.cancel_fit_button.clicked.connect(self.cancel_fit)
+        self.cancel_fit_button.setEnabled(False)
+
+        self.fit_progress = QProgressBar()
+        self.fit_progress.setMinimum(0)
+        self.fit_progress.setValue(0)
+
+        self.follow_fit_cb = QCheckBox("Follow Fit")
+        self.follow_fit_cb.setChecked(False)
+
         self.grid_cb = QCheckBox("Show &Grid")
         self.grid_cb.setChecked(False)
         self.grid_cb.stateChanged.connect(self.update_plot)
@@ -437,6 +801,9 @@ class FitViewWindow(QMainWindow):
         self.fit_result_to_param_button = QPushButton("Fit Result to Params")
         self.fit_result_to_param_button.clicked.connect(self.fit_result_to_params)
 
+        self.trend_button = QPushButton("Parameter Trends")
+        self.trend_button.clicked.connect(self.show_trend_window)
+
 
         self.fit_result_cb = QCheckBox("Fit Results")
         self.fit_result_cb.setChecked(False)
@@ -454,6 +821,16 @@ class FitViewWindow(QMainWindow):
 
         self.fit_in_reverse_cb = QCheckBox("Fit in Reverse")
         self.fit_in_reverse_cb.setChecked(False)
+
+        self.warm_start_cb = QCheckBox("Seed from nearest fit")
+        self.warm_start_cb.setChecked(False)
+        self.warm_start_cb.setToolTip('Start every spectrum from its nearest already fitted neighbour\n'
+            '(by spectrum index). Overrides the chaining options.')
+
+        self.parallel_fit_cb = QCheckBox("Parallel (all cores)")
+        self.parallel_fit_cb.setChecked(False)
+        self.parallel_fit_cb.setToolTip('Fit every point from the same params in a process pool.\n'
+            'Ignored when chaining with prev pars or fitting in reverse.')
         # self.autofit_cb.stateChanged.connect(self.autofit)
 
 # self.autofit = XPyS.autofit.autofit.autofit(self.spectra_object.esub,self.spectra_object.isub[specnum[0]],self.spectra_object.orbital)
@@ -467,30 +844,26 @@ class FitViewWindow(QMainWindow):
 
 
 
-        """Tree for choosing which spectra to fit/view"""
-        self.spectra_tree = QTreeWidget(self)
-        parent = QTreeWidgetItem(self.spectra_tree)
-        parent.setText(0,'All')
-
-        parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
-
-        for ch in [str(i) for i in range(len(self.spectra_obj.isub))]:
-            child1 = QTreeWidgetItem(parent)
-            child1.setFlags(child1.flags() | Qt.ItemIsUserCheckable)
-            child1.setText(0, ch)
-            child1.setCheckState(0, Qt.Unchecked)      
+        """List for choosing which spectra to fit"""
+        self.spectra_select = SpectraSelector(len(self.spectra_obj.isub), self)
 
         """Layout with box sizers"""
         hbox = QHBoxLayout()
         
         fitControlLayout = QVBoxLayout()
         fitControlLayout.addWidget(self.fit_button)
+        fitControlLayout.addWidget(self.cancel_fit_button)
+        fitControlLayout.addWidget(self.fit_progress)
         fitControlLayout.addWidget(self.update_prev_pars_cb)
         fitControlLayout.addWidget(self.fit_in_reverse_cb)
+        fitControlLayout.addWidget(self.warm_start_cb)
+        fitControlLayout.addWidget(self.parallel_fit_cb)
+        fitControlLayout.addWidget(self.follow_fit_cb)
 
         specControlLayout = QVBoxLayout()
         specControlLayout.addWidget(self.spectra_plot_box)
         specControlLayout.addWidget(self.fit_result_to_param_button)
+        specControlLayout.addWidget(self.trend_button)
 
         for w in [self.adj_params_button,self.load_model_button, fitControlLayout, self.grid_cb, self.autofitButton, self.autofit_cb,self.fit_result_cb, specControlLayout]:
             if (w is fitControlLayout) or (w is specControlLayout):
@@ -506,7 +879,7 @@ class FitViewWindow(QMainWindow):
 
         hboxmain = QHBoxLayout()
         hboxmain.addLayout(vbox)
-        hboxmain.addWidget(self.spectra_tree)
+        hboxmain.addWidget(self.spectra_select)
 
         
         self.main_frame.setLayout(hboxmain)
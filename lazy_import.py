@@ -0,0 +1,92 @@
+"""
+Deferred imports, so the main window can show before the heavy modules load.
+
+    np = lazy('numpy')                                 # imported on first np.xxx
+    FitViewWindow = lazy_attr('fitwindow','FitViewWindow')   # imported on first call
+
+Every import done through here is timed, report() prints the table.
+"""
+import importlib
+import time
+
+import_times = {}
+verbose = False
+
+
+def record(name, seconds):
+    import_times.setdefault(name, seconds)
+    if verbose:
+        print('import %-50s %7.3f s' % (name, seconds))
+
+
+def timed_import(name):
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    if name not in import_times:
+        record(name, time.perf_counter() - t0)
+    return module
+
+
+class LazyModule:
+    """Module proxy, the import happens on the first attribute access.
+
+    Submodules that the package doesn't import itself are imported on access
+    too, so lazy('XPyS').io.load_sample works like import XPyS.io would.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = timed_import(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            try:
+                return timed_import(self._name + '.' + attr)
+            except ImportError:
+                raise AttributeError("module '%s' has no attribute '%s'" % (self._name, attr))
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+
+class LazyAttr:
+    """Proxy for a class or function of a module that is imported on first use"""
+
+    def __init__(self, module_name, attr):
+        self._module = LazyModule(module_name)
+        self._attr = attr
+
+    def _load(self):
+        return getattr(self._module, self._attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def lazy(name):
+    return LazyModule(name)
+
+
+def lazy_attr(module_name, attr):
+    return LazyAttr(module_name, attr)
+
+
+def report(startup = None):
+    """Print the time spent in each import so far, slowest first"""
+    if startup is not None:
+        print('Window shown after %.3f s' % startup)
+    print('Imports (for a full breakdown run python -X importtime xpsui.py):')
+    for name, seconds in sorted(import_times.items(), key = lambda item: -item[1]):
+        print('  %-50s %7.3f s' % (name, seconds))
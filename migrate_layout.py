@@ -0,0 +1,63 @@
+"""
+Rewrite sample files into a chunked, compressed layout, or back again.
+
+Spectra are chunked a row at a time and fit tables a column at a time (see
+sample_io.StorageLayout), so the GUI reads one spectrum or one parameter
+trend without pulling the rest of the file over the network. Contiguous files
+can be memory mapped when lazy loading, chunked ones can't, so local working
+copies may be better off left as they are.
+
+    python migrate_layout.py sample.hdf5 --compression gzip --level 4
+    python migrate_layout.py /path/to/sample_library --compression lzf --no-backup
+    python migrate_layout.py sample.hdf5 --contiguous
+"""
+import sys, os
+import glob
+import argparse
+
+import sample_io
+
+
+def sample_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path,'**','*.hdf5'), recursive = True))
+    return [path]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Rewrite XPS sample files with chunked, compressed datasets')
+    parser.add_argument('path', help = 'sample .hdf5 file or a directory of them')
+    parser.add_argument('--compression', choices = ['gzip','lzf','none'], default = 'gzip')
+    parser.add_argument('--level', type = int, default = 4, help = 'gzip level, 0-9 (default: 4)')
+    parser.add_argument('--rows-per-chunk', type = int, default = 1, help = 'spectra per chunk of I, isub and bg')
+    parser.add_argument('--column-chunk', type = int, default = 4096, help = 'spectra per chunk of a fit table column')
+    parser.add_argument('--contiguous', action = 'store_true', \
+        help = 'undo: write contiguous, uncompressed datasets that can be memory mapped')
+    parser.add_argument('--no-backup', action = 'store_true', help = 'do not keep the original as .bak')
+    args = parser.parse_args(argv)
+
+    if args.contiguous:
+        layout = None
+    else:
+        layout = sample_io.StorageLayout(compression = None if args.compression == 'none' else args.compression, \
+            level = args.level, rows_per_chunk = args.rows_per_chunk, column_chunk = args.column_chunk)
+
+    failed = []
+    for filepath in sample_files(args.path):
+        size = os.path.getsize(filepath)
+        try:
+            sample_io.migrate_file(filepath, layout, backup = not args.no_backup)
+        except Exception as e:
+            print('Failed on',filepath,':',e)
+            failed.append(filepath)
+            continue
+        print(filepath,'%.1f MB -> %.1f MB' % (size/1e6, os.path.getsize(filepath)/1e6))
+
+    if failed != []:
+        print(len(failed),'files failed')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
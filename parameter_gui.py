@@ -34,6 +34,14 @@ from IPython import embed as shell
 
 
 class ParameterWindow(QMainWindow):
+    """Controls for the model parameters, one collapsible group per model component.
+
+    A component's ParamGroupBoxes are only built the first time its group is
+    expanded, widgetsBuilt then sends the names of the new parameter widgets so
+    their signals can be connected.
+    """
+    widgetsBuilt = pyqtSignal(list)
+
     def __init__(self, parent=None,model = None, pairlist = None, element_ctrl = None, params = None, E = None):
         super(ParameterWindow, self).__init__(parent)
 
@@ -70,17 +78,34 @@ class ParameterWindow(QMainWindow):
         # self.resize(425, 392)        
 
         
-        self.paramwidgets = {p_name:ParamGroupBox(par = p,limits = self.ctrl_lims[p_name])\
-                for p_name, p in self.params.items() if p_name in self.rel_pars}
-
-        # shell()
+        self.paramwidgets = {}
+        self.group_buttons = []
+        self.group_frames = []
 
         layout = QVBoxLayout()
-        for group in self.modgroups:
-            hbox = QHBoxLayout()
-            for par in group:
-                hbox.addWidget(self.paramwidgets[par].groupbox)
-            layout.addLayout(hbox)
+        for k, component in enumerate(self.mod.components):
+            button = QToolButton()
+            button.setText(component.prefix.rstrip('_') if component.prefix else component._name)
+            button.setToolButtonStyle(Qt.ToolButtonTextBesideIcon)
+            button.setArrowType(Qt.RightArrow)
+            button.setCheckable(True)
+            button.setStyleSheet("QToolButton { border: none; }")
+            button.toggled.connect(lambda checked, k=k: self.expand_group(k, checked))
+
+            frame = QWidget()
+            frame.setLayout(QHBoxLayout())
+            frame.layout().setContentsMargins(0,0,0,0)
+            frame.hide()
+
+            self.group_buttons.append(button)
+            self.group_frames.append(frame)
+            layout.addWidget(button)
+            layout.addWidget(frame)
+        layout.addStretch(1)
+
+        # The first component is open from the start
+        if self.group_buttons != []:
+            self.group_buttons[0].setChecked(True)
 
         widget = QWidget()
         widget.setLayout(layout)
@@ -91,6 +116,20 @@ class ParameterWindow(QMainWindow):
         self.setCentralWidget(Area)
         # self.show(Area)
 
+    def expand_group(self, k, expanded):
+        self.group_buttons[k].setArrowType(Qt.DownArrow if expanded else Qt.RightArrow)
+        if expanded:
+            self.build_group(k)
+        self.group_frames[k].setVisible(expanded)
+
+    def build_group(self, k):
+        new = [par for par in self.modgroups[k] if (par in self.params) and (par not in self.paramwidgets)]
+        for par in new:
+            self.paramwidgets[par] = ParamGroupBox(par = self.params[par],limits = self.ctrl_lims[par])
+            self.group_frames[k].layout().addWidget(self.paramwidgets[par].groupbox)
+        if new != []:
+            self.widgetsBuilt.emit(new)
+
 class ParamGroupBox(QWidget):
     def __init__(self, par,limits, number_of_slider_points = 100):
         super(ParamGroupBox, self).__init__()
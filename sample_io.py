@@ -0,0 +1,640 @@
+"""
+HDF5 access for the GUI that doesn't go through XPyS.io.
+
+The sample files keep one group per experiment and inside it one group per
+orbital holding the E, I (and once analysed esub, isub, bg, ...) datasets.
+"""
+import os
+import ast
+import json
+import threading
+from contextlib import contextmanager
+import h5py
+import numpy as np
+import lmfit as lm
+from lmfit.model import ModelResult
+
+import changes
+import bg_engine
+
+
+# HDF5 refuses to open a file for writing that this process has open read only.
+# Reads through open_readonly hold this lock while the file is open and writes
+# take it to open and close theirs, so a save on the SaveWorker thread never
+# meets a read from the GUI thread. Reads during a save share its handle.
+_file_lock = threading.RLock()
+
+
+@contextmanager
+def open_readonly(filepath):
+    """Open filepath read only without taking HDF5 file locks, so browsing a shared
+    library doesn't block someone writing to it. Falls back to a plain read only
+    open on older h5py, or when this process has the file open for a save."""
+    with _file_lock:
+        try:
+            f = h5py.File(filepath, 'r', locking = False)
+        except (TypeError, OSError):
+            f = h5py.File(filepath, 'r')
+        with f:
+            yield f
+
+
+@contextmanager
+def open_writable(filepath):
+    """Open filepath for writing until the block ends. Only opening and closing
+    wait for reads from other threads, reads meanwhile go through this handle."""
+    with _file_lock:
+        f = h5py.File(filepath, 'r+')
+    try:
+        yield f
+    finally:
+        with _file_lock:
+            f.close()
+
+
+@contextmanager
+def reads_held():
+    """Keep reads from this process out while the block writes the file some other
+    way (XPyS.io), which opens it itself"""
+    with _file_lock:
+        yield
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray) and value.dtype.kind in ('S','O'):
+        return [_decode(v) for v in value.tolist()]
+    return value
+
+
+def read_attr(obj, name, default = None):
+    """Attribute or small dataset of an h5py object, strings decoded and literals parsed"""
+    if name in obj.attrs:
+        value = _decode(obj.attrs[name])
+    elif (name in obj) and isinstance(obj[name], h5py.Dataset):
+        value = _decode(obj[name][()])
+    else:
+        return default
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    return value
+
+
+def loads_params(s):
+    return lm.Parameters().loads(_decode(s))
+
+
+def loads_model(s):
+    """Model from Model.dumps. Lineshapes are found by name, anything else needs
+    dill to have been installed when it was saved."""
+    return lm.Model(lambda x: x).loads(_decode(s))
+
+
+# Attributes saved as lmfit JSON rather than Python literals
+LMFIT_ATTRS = {'params': loads_params, 'mod': loads_model}
+
+
+def memmap_dataset(ds):
+    """Read only np.memmap of a dataset stored contiguously and uncompressed in its
+    file, None when it isn't stored that way (chunked, filtered, external, empty)"""
+    if (ds.chunks is not None) or (ds.external is not None) or (ds.dtype.kind not in 'biuf') or (ds.size == 0):
+        return None
+    offset = ds.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(ds.file.filename, mode = 'r', dtype = ds.dtype, shape = ds.shape, offset = offset)
+
+
+def row_chunked(ds):
+    """Is ds a matrix chunked a few rows at a time, so a row can be read on its own"""
+    return (ds.ndim == 2) and (ds.chunks is not None) and (ds.chunks[0] < ds.shape[0])
+
+
+class RowView:
+    """Rows of a row chunked dataset, read from the file one spectrum at a time.
+
+    Indexing with a single spectrum only reads (and decompresses) that row's
+    chunk. Anything else, slicing or handing it to numpy, reads the whole
+    matrix once and keeps it.
+    """
+
+    def __init__(self, spectra, name):
+        self._spectra = spectra
+        self._name = name
+        with spectra._read() as grp:
+            ds = grp[name]
+            self.shape, self.dtype, self.ndim = ds.shape, ds.dtype, ds.ndim
+        self._array = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def array(self):
+        if self._array is None:
+            with self._spectra._read() as grp:
+                self._array = grp[self._name][()]
+        return self._array
+
+    def __getitem__(self, key):
+        if (self._array is None) and isinstance(key, (int, np.integer)):
+            with self._spectra._read() as grp:
+                return grp[self._name][key]
+        return self.array()[key]
+
+    def __array__(self, dtype = None, copy = None):
+        return self.array() if dtype is None else self.array().astype(dtype)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.array(), name)
+
+
+def is_orbital_group(grp):
+    return isinstance(grp, h5py.Group) and ('E' in grp) and ('I' in grp)
+
+
+class LazySpectra:
+    """Stand-in for an XPyS spectra object that reads its datasets on first use.
+
+    Attribute access falls through to the orbital group: a dataset is read once
+    and kept, attributes are returned as is. Nothing is read when it is built,
+    and the file is only open while something is read (LazySample.reading).
+    With memmap the raw E and I are mapped read only straight from the file
+    where the layout allows it, so only derived arrays (isub, bg, ...) take RAM.
+    A row chunked (StorageLayout) I can't be mapped and is read a row at a time.
+
+    The model, parameters and fits saved by write_spectra_analysis are rebuilt
+    the first time any of them is used (read_analysis).
+    """
+    MAPPED = ['E','I']
+    ANALYSIS = ['params','mod','pairlist','element_ctrl','fit_results']
+
+    def __init__(self, sample, orbital, memmap = False):
+        self._sample = sample
+        self._memmap = memmap
+        self.orbital = orbital
+        changes.mark_clean(self)
+        changes.mark_saved(self)
+
+    @contextmanager
+    def _read(self):
+        """The orbital group, in the sample file opened for as long as this is used"""
+        with self._sample.reading() as experiment:
+            yield experiment[self.orbital]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.ANALYSIS:
+            # Rebuilt together the first time any of them is asked for
+            if '_analysis_read' not in self.__dict__:
+                self.__dict__['_analysis_read'] = True
+                with self._read() as grp:
+                    read_analysis(grp, self)
+                changes.params_loaded(self)
+            if name in self.__dict__:
+                return self.__dict__[name]
+            raise AttributeError("'%s' has no '%s' saved" % (self.orbital, name))
+        with self._read() as grp:
+            if (name in grp) and isinstance(grp[name], h5py.Dataset):
+                value = None
+                if self._memmap and (name in self.MAPPED):
+                    value = memmap_dataset(grp[name])
+                    if (value is None) and row_chunked(grp[name]):
+                        value = RowView(self, name)
+                if value is None:
+                    value = grp[name][()]
+            elif name in grp.attrs:
+                value = read_attr(grp, name)
+            else:
+                raise AttributeError("'%s' has no '%s' saved" % (self.orbital, name))
+        self.__dict__[name] = value
+        return value
+
+    def n_spectra(self):
+        """Number of spectra, from the dataset shape only"""
+        with self._read() as grp:
+            return grp['I'].shape[0]
+
+    def bg_sub(self, subpars):
+        """There is no XPyS spectra object behind a lazy orbital. bg_engine.run_bg_sub
+        only gets here when the batch backgrounds weren't asked for or can't be used,
+        which lazy orbitals can't do without."""
+        if bg_engine.can_batch(subpars):
+            raise ValueError("%s is lazily loaded, check Batch backgrounds or load it without Lazy Load" % self.orbital)
+        raise ValueError("UT2 with B or C varying needs XPyS, load %s without Lazy Load" % self.orbital)
+
+
+class LazyBGInfo(dict):
+    """sample.bg_info that reads an orbital's settings the first time it is asked for"""
+
+    def __init__(self, sample):
+        super().__init__()
+        self._sample = sample
+
+    def __missing__(self, orbital):
+        with self._sample.reading() as experiment:
+            grp = experiment[orbital]
+            bg_info = read_attr(grp, 'bg_info')
+            if bg_info is None:
+                E = grp['E'][()]
+                bg_info = [(float(np.min(E)), float(np.max(E))), 'shirley']
+        bg_info = list(bg_info)
+        self[orbital] = bg_info
+        return bg_info
+
+
+class LazySample:
+    """Sample that only reads group metadata when it is opened.
+
+    The file is only open, read only and without locks (open_readonly), while
+    something is being read, so having a sample loaded never stops anyone else
+    saving into it. Every orbital gets a LazySpectra in the instance __dict__
+    straight away, so code indexing sample.__dict__[orbital] keeps working, but
+    E/I/isub are only read from disk when they are used. With memmap (the
+    default) raw spectra are memory mapped rather than read.
+    """
+
+    def __init__(self, filepath, experiment_name, memmap = True):
+        self.load_path = filepath
+        self.experiment_name = experiment_name
+
+        with self.reading() as experiment:
+            self.sample_name = read_attr(experiment, 'sample_name', \
+                default = os.path.splitext(os.path.basename(filepath))[0])
+            self.element_scans = read_attr(experiment, 'element_scans', \
+                default = [k for k in experiment.keys() if is_orbital_group(experiment[k])])
+            self.all_scans = read_attr(experiment, 'all_scans', default = list(self.element_scans))
+        self.bg_info = LazyBGInfo(self)
+
+        for orbital in self.element_scans:
+            self.__dict__[orbital] = LazySpectra(self, orbital, memmap = memmap)
+        changes.mark_clean(self)
+
+    @contextmanager
+    def reading(self):
+        """The experiment group, in the file opened read only for as long as this is used"""
+        with open_readonly(self.load_path) as f:
+            yield f[self.experiment_name]
+
+    def xpys_analysed(self):
+        """Orbitals with an analysis saved by XPyS.io rather than through here, which
+        only XPyS.io.load_sample can read back"""
+        orbitals = []
+        with self.reading() as experiment:
+            for orbital in self.element_scans:
+                grp = experiment[orbital]
+                analysed = any([name in grp for name in ANALYSIS_ARRAYS + ['fit_results']]) or ('params' in grp.attrs)
+                if analysed and (SAVED_MARK not in grp.attrs):
+                    orbitals.append(orbital)
+        return orbitals
+
+    def close(self):
+        """Drop the memory maps, the only thing kept open between reads"""
+        for orbital in self.element_scans:
+            for name in LazySpectra.MAPPED:
+                if isinstance(self.__dict__[orbital].__dict__.get(name), np.memmap):
+                    del self.__dict__[orbital].__dict__[name]
+
+
+class StorageLayout:
+    """Chunking and compression for the datasets written into a sample file.
+
+    Intensity matrices (I, isub, bg) get chunks of rows_per_chunk spectra, so
+    showing one spectrum reads one small chunk rather than a compressed block
+    of the whole map. The fit tables are kept as one 1-D dataset per field
+    (fit_values/<param>, ...) chunked along the spectra, which is how the trend
+    plots read them. compression is None, 'gzip' (with level) or 'lzf'.
+
+    A file's layout is kept in its 'layout' attribute so later saves follow it.
+    Files without one are contiguous and uncompressed, the only layout that
+    can be memory mapped.
+    """
+    MATRICES = ['I','isub','bg']
+
+    def __init__(self, compression = 'gzip', level = 4, rows_per_chunk = 1, column_chunk = 4096, shuffle = True):
+        if compression not in [None,'gzip','lzf']:
+            raise ValueError('Unknown compression: %s' % compression)
+        self.compression = compression
+        self.level = level
+        self.rows_per_chunk = rows_per_chunk
+        self.column_chunk = column_chunk
+        self.shuffle = shuffle
+
+    def filters(self):
+        if self.compression is None:
+            return {}
+        return {'compression': self.compression, 'shuffle': self.shuffle, \
+            'compression_opts': self.level if self.compression == 'gzip' else None}
+
+    def matrix_options(self, shape):
+        if (len(shape) != 2) or (0 in shape):
+            return {}
+        return dict(chunks = (min(self.rows_per_chunk, shape[0]), shape[1]), **self.filters())
+
+    def column_options(self, shape):
+        if (len(shape) != 1) or (shape[0] == 0):
+            return {}
+        return dict(chunks = (min(self.column_chunk, shape[0]),), **self.filters())
+
+    def dumps(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def of_file(cls, f):
+        """The layout saved in file f, None for the default contiguous one"""
+        if 'layout' not in f.attrs:
+            return None
+        return cls(**json.loads(_decode(f.attrs['layout'])))
+
+
+def dataset_options(layout, name, shape):
+    if (layout is None) or (name not in StorageLayout.MATRICES):
+        return {}
+    return layout.matrix_options(shape)
+
+
+# Saving. Everything for one save goes through a single open file and only the
+# parts changes.py has marked as modified are rewritten.
+ANALYSIS_ARRAYS = ['esub','isub','bg']
+FIT_TABLES = ['fit_values','fit_stderr','fit_stats']
+# Set on an orbital group once its analysis has been written through here, so
+# its params, mod and fit tables are known to be complete and current. A save
+# through XPyS.io removes it again (forget_saved_analysis).
+SAVED_MARK = 'gui_analysis'
+
+def write_dataset(grp, name, data, **options):
+    """Write data to grp[name], in place when the shape and dtype still match.
+
+    options (chunks, compression, ...) only apply when the dataset is created.
+    """
+    if isinstance(data, str):
+        if name in grp:
+            del grp[name]
+        return grp.create_dataset(name, data = data, dtype = h5py.string_dtype())
+    data = np.asarray(data)
+    if name in grp:
+        ds = grp[name]
+        if isinstance(ds, h5py.Dataset) and (ds.shape == data.shape) and (ds.dtype == data.dtype):
+            ds[...] = data
+            return ds
+        del grp[name]
+    return grp.create_dataset(name, data = data, **options)
+
+
+def write_rows(grp, name, table, rows, **options):
+    """Write only the given rows of table when grp[name] already has its shape and dtype"""
+    if (name in grp) and isinstance(grp[name], h5py.Dataset) and \
+        (grp[name].shape == table.shape) and (grp[name].dtype == table.dtype):
+        if len(rows) > 0:
+            grp[name][rows] = table[rows]
+        return grp[name]
+    return write_dataset(grp, name, table, **options)
+
+
+def write_table(grp, name, table, rows, layout = None):
+    """Write the given rows of a structured table, as one dataset or with a
+    layout as a group of one column dataset per field"""
+    if layout is None:
+        if (name in grp) and isinstance(grp[name], h5py.Group):
+            del grp[name]
+        return write_rows(grp, name, table, rows)
+
+    if (name in grp) and isinstance(grp[name], h5py.Dataset):
+        del grp[name]
+    columns = grp[name] if name in grp else grp.create_group(name, track_order = True)
+    for field in list(columns.keys()):
+        if field not in table.dtype.names:
+            del columns[field]
+    for field in table.dtype.names:
+        write_rows(columns, field, table[field], rows, **layout.column_options(table.shape))
+    return columns
+
+
+def read_table(obj):
+    """Structured array of a fit table saved either way by write_table"""
+    if isinstance(obj, h5py.Dataset):
+        return obj[()]
+    fields = list(obj.keys())
+    table = np.zeros(obj[fields[0]].shape if fields else (0,), dtype = [(f, obj[f].dtype) for f in fields])
+    for f in fields:
+        table[f] = obj[f][()]
+    return table
+
+
+def write_spectra_analysis(experiment, orbital, spectra_obj):
+    """Write the analysis of one orbital into the experiment group, in the file's layout.
+
+    What is written comes from the changes taken off spectra_obj first, which
+    are returned so a failed save further on can put them back.
+    """
+    grp = experiment.require_group(orbital)
+    dirty = changes.take_dirty(spectra_obj)
+    try:
+        # Nothing of ours there yet (new, or last saved by XPyS.io), so all of it is written
+        write_changes(grp, spectra_obj, dirty if SAVED_MARK in grp.attrs else None, StorageLayout.of_file(experiment.file))
+        grp.attrs[SAVED_MARK] = 1
+    except Exception:
+        changes.restore_dirty(spectra_obj, dirty)
+        raise
+    return dirty
+
+
+def write_changes(grp, spectra_obj, dirty, layout = None):
+    for name in ANALYSIS_ARRAYS:
+        if hasattr(spectra_obj, name) and changes.field_dirty(dirty, name):
+            data = getattr(spectra_obj, name)
+            write_dataset(grp, name, data, **dataset_options(layout, name, np.shape(data)))
+
+    if hasattr(spectra_obj, 'bg_info') and changes.field_dirty(dirty, 'bg_info'):
+        grp.attrs['bg_info'] = str(list(spectra_obj.bg_info))
+
+    # Compared with what is stored as well, params can be changed without a mark
+    if hasattr(spectra_obj, 'params') and (changes.field_dirty(dirty, 'params') or \
+        (_decode(grp.attrs.get('params')) != spectra_obj.params.dumps())):
+        grp.attrs['params'] = spectra_obj.params.dumps()
+        if hasattr(spectra_obj, 'mod'):
+            grp.attrs['mod'] = spectra_obj.mod.dumps()
+        for name in ['pairlist','element_ctrl']:
+            if hasattr(spectra_obj, name):
+                grp.attrs[name] = str(getattr(spectra_obj, name))
+
+    if hasattr(spectra_obj, 'fit_results') and hasattr(spectra_obj.fit_results, 'tables'):
+        # FitResultStore, the parameter tables are written row by row
+        rows = changes.field_indices(dirty, 'fit_results', len(spectra_obj.fit_results))
+        for name, table in spectra_obj.fit_results.tables().items():
+            write_table(grp, name, table, rows, layout = layout)
+    elif hasattr(spectra_obj, 'fit_results'):
+        fit_grp = grp.require_group('fit_results')
+        for i in changes.field_indices(dirty, 'fit_results', len(spectra_obj.fit_results)):
+            if spectra_obj.fit_results[i] != []:
+                write_dataset(fit_grp, str(i), spectra_obj.fit_results[i].dumps())
+
+
+def read_fit_results(grp, spectra_obj):
+    """fit_results saved in grp for spectra_obj's model, None when there are none"""
+    import fitting
+    if all([name in grp for name in FIT_TABLES]):
+        return fitting.FitResultStore.from_tables(spectra_obj, {name: read_table(grp[name]) for name in FIT_TABLES})
+    if (SAVED_MARK in grp.attrs) and isinstance(grp.get('fit_results'), h5py.Group):
+        # Written one ModelResult dump per fitted spectrum
+        fit_results = [[] for i in range(len(spectra_obj.isub))]
+        for key, ds in grp['fit_results'].items():
+            fit_results[int(key)] = ModelResult(spectra_obj.mod, spectra_obj.params.copy()).loads(_decode(ds[()]))
+        return fit_results
+    return None
+
+
+def read_analysis(grp, spectra_obj):
+    """Set spectra_obj's params, mod, pairlist, element_ctrl and fit_results from what
+    write_spectra_analysis saved in grp"""
+    for name, loads in LMFIT_ATTRS.items():
+        if name in grp.attrs:
+            setattr(spectra_obj, name, loads(grp.attrs[name]))
+    for name in ['pairlist','element_ctrl']:
+        if name in grp.attrs:
+            setattr(spectra_obj, name, read_attr(grp, name))
+    if hasattr(spectra_obj, 'mod') and hasattr(spectra_obj, 'params') and hasattr(spectra_obj, 'isub'):
+        fit_results = read_fit_results(grp, spectra_obj)
+        if fit_results is not None:
+            spectra_obj.fit_results = fit_results
+
+
+def load_saved_analysis(sample):
+    """Put back the analysis saved through here into a sample loaded with XPyS.io.load_sample,
+    which doesn't know these attributes and tables. Returns the orbitals read."""
+    loaded = []
+    with open_readonly(sample.load_path) as f:
+        experiment = f[sample.experiment_name]
+        for orbital in sample.element_scans:
+            if (orbital in experiment) and (SAVED_MARK in experiment[orbital].attrs):
+                read_analysis(experiment[orbital], sample.__dict__[orbital])
+                loaded.append(orbital)
+    return loaded
+
+
+def forget_saved_analysis(filepath, experiment_name, orbitals = None):
+    """After XPyS.io has saved over orbitals, drop the fit tables and mark written
+    here so they aren't read back over what XPyS saved"""
+    with open_writable(filepath) as f:
+        experiment = f[experiment_name]
+        for orbital in (orbitals if orbitals is not None else list(experiment.keys())):
+            grp = experiment.get(orbital)
+            if (not isinstance(grp, h5py.Group)) or (SAVED_MARK not in grp.attrs):
+                continue
+            for name in FIT_TABLES:
+                if name in grp:
+                    del grp[name]
+            del grp.attrs[SAVED_MARK]
+
+
+def open_for_write(sample):
+    """The sample file opened once for writing, closed again when the save ends.
+    Never the handle a LazySample reads through, it has none between reads."""
+    return open_writable(sample.load_path)
+
+
+def save_spectra_batch(sample, orbitals, progress = None):
+    """Save the analysis of several orbitals in one transaction on one file handle.
+
+    progress is called with (n_done, n_total, orbital) after each orbital. If
+    anything fails, every orbital keeps its changes for the next save.
+    """
+    taken = []
+    saved = []
+    try:
+        with open_for_write(sample) as f:
+            experiment = f.require_group(sample.experiment_name)
+            for n, orbital in enumerate(orbitals):
+                spectra_obj = sample.__dict__[orbital]
+                saved.append((spectra_obj, changes.content(spectra_obj)))
+                taken.append((spectra_obj, write_spectra_analysis(experiment, orbital, spectra_obj)))
+                if progress is not None:
+                    progress(n+1, len(orbitals), orbital)
+            f.flush()
+    except Exception:
+        changes.restore_all(taken)
+        raise
+    for spectra_obj, content in saved:
+        changes.mark_saved(spectra_obj, content)
+
+
+def save_sample_incremental(sample, progress = None):
+    """Save only the orbitals and bg_info changed since the sample was loaded or last saved.
+
+    Returns the orbitals written, nothing is opened when nothing changed.
+    """
+    if changes.dirty_orbitals(sample) == []:
+        return []
+    sample_dirty = changes.take_dirty(sample)
+    taken = [(sample, sample_dirty)]
+    orbitals = changes.changed_orbitals(sample, sample_dirty)
+    saved = []
+    try:
+        with open_for_write(sample) as f:
+            experiment = f.require_group(sample.experiment_name)
+            if sample_dirty is None:
+                for name in ['sample_name','element_scans','all_scans']:
+                    if hasattr(sample, name):
+                        experiment.attrs[name] = str(getattr(sample, name))
+            for n, orbital in enumerate(orbitals):
+                spectra_obj = sample.__dict__[orbital]
+                saved.append((spectra_obj, changes.content(spectra_obj)))
+                taken.append((spectra_obj, write_spectra_analysis(experiment, orbital, spectra_obj)))
+                if orbital in sample.bg_info:
+                    experiment[orbital].attrs['bg_info'] = str(list(sample.bg_info[orbital]))
+                if progress is not None:
+                    progress(n+1, len(orbitals), orbital)
+            f.flush()
+    except Exception:
+        changes.restore_all(taken)
+        raise
+    for spectra_obj, content in saved:
+        changes.mark_saved(spectra_obj, content)
+    return orbitals
+
+
+def copy_group(src, dst, layout):
+    """Copy every attribute, group and dataset of src into dst, laid out with layout"""
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+    for name, obj in src.items():
+        if (name in FIT_TABLES) and (isinstance(obj, h5py.Group) or (obj.dtype.names is not None)):
+            write_table(dst, name, read_table(obj), [], layout = layout)
+        elif isinstance(obj, h5py.Group):
+            copy_group(obj, dst.create_group(name), layout)
+        elif obj.dtype.kind in 'biuf':
+            ds = dst.create_dataset(name, data = obj[()], **dataset_options(layout, name, obj.shape))
+            for key, value in obj.attrs.items():
+                ds.attrs[key] = value
+        else:
+            src.copy(obj, dst, name = name)
+
+
+def migrate_file(filepath, layout, backup = True):
+    """Rewrite a sample file with layout (None for contiguous and uncompressed).
+
+    The new file is written next to the old one and swapped in once complete,
+    with backup the original is kept as filepath + '.bak'.
+    """
+    tmp_path = filepath + '.migrating'
+    try:
+        with h5py.File(filepath, 'r') as src, h5py.File(tmp_path, 'w') as dst:
+            copy_group(src, dst, layout)
+            if layout is None:
+                if 'layout' in dst.attrs:
+                    del dst.attrs['layout']
+            else:
+                dst.attrs['layout'] = layout.dumps()
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if backup:
+        os.replace(filepath, filepath + '.bak')
+    os.replace(tmp_path, filepath)
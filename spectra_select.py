@@ -0,0 +1,151 @@
+"""
+Spectrum selector for the fit window.
+
+The checked spectra live in a numpy bool mask, the list view only asks for
+rows as they are scrolled into view, so a 2000 point map costs no more to
+open than a 20 point depth profile.
+"""
+import re
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+
+
+def parse_ranges(text, n):
+    """Bool mask of n spectra from text like '0-99, step 5', '3, 7, 10-20:2' or 'all'.
+
+    Ranges are inclusive. 'step k' applies to the range before it. Raises
+    ValueError on anything else.
+    """
+    mask = np.zeros(n, dtype = bool)
+    ranges = []
+    for part in [p.strip().lower() for p in text.split(',') if p.strip() != '']:
+        m = re.fullmatch(r'step\s*(\d+)', part)
+        if m:
+            if ranges == []:
+                raise ValueError("'%s' needs a range before it" % part)
+            ranges[-1][2] = int(m.group(1))
+            continue
+        if part == 'all':
+            ranges.append([0, n-1, 1])
+            continue
+        m = re.fullmatch(r'(\d+)(?:\s*-\s*(\d+))?(?:\s*(?::|step)\s*(\d+))?', part)
+        if not m:
+            raise ValueError("Can't read '%s', use e.g. 0-99, step 5" % part)
+        start = int(m.group(1))
+        stop = int(m.group(2)) if m.group(2) is not None else start
+        ranges.append([start, stop, int(m.group(3)) if m.group(3) is not None else 1])
+
+    for start, stop, step in ranges:
+        if step < 1:
+            raise ValueError('step has to be at least 1')
+        if start > stop:
+            start, stop = stop, start
+        mask[start:min(stop, n-1)+1:step] = True
+    return mask
+
+
+class SpectraSelectModel(QAbstractListModel):
+    """Checkable list of spectrum indices backed by a bool mask"""
+    selectionChanged = pyqtSignal()
+    batch = 256
+
+    def __init__(self, n, parent = None):
+        super().__init__(parent)
+        self.mask = np.zeros(n, dtype = bool)
+        self.loaded = min(n, self.batch)
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent):
+        return (not parent.isValid()) and (self.loaded < len(self.mask))
+
+    def fetchMore(self, parent):
+        n = min(self.batch, len(self.mask) - self.loaded)
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + n - 1)
+        self.loaded += n
+        self.endInsertRows()
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return str(index.row())
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self.mask[index.row()] else Qt.Unchecked
+        return None
+
+    def setData(self, index, value, role = Qt.EditRole):
+        if (not index.isValid()) or (role != Qt.CheckStateRole):
+            return False
+        self.mask[index.row()] = (value == Qt.Checked)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.selectionChanged.emit()
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def set_mask(self, mask):
+        self.mask[:] = mask
+        if self.loaded > 0:
+            self.dataChanged.emit(self.index(0), self.index(self.loaded - 1), [Qt.CheckStateRole])
+        self.selectionChanged.emit()
+
+    def selected(self):
+        return np.flatnonzero(self.mask)
+
+
+class SpectraSelector(QWidget):
+    """List of spectra to check by hand, plus a range box for checking many at once"""
+
+    def __init__(self, n, parent = None):
+        super().__init__(parent)
+        self.model = SpectraSelectModel(n, self)
+
+        self.view = QListView(self)
+        self.view.setUniformItemSizes(True)
+        self.view.setModel(self.model)
+
+        self.range_text = QLineEdit(self)
+        self.range_text.setPlaceholderText('e.g. 0-99, step 5')
+        self.range_text.returnPressed.connect(self.select_ranges)
+
+        self.all_button = QPushButton('All', self)
+        self.all_button.clicked.connect(lambda: self.model.set_mask(True))
+        self.none_button = QPushButton('None', self)
+        self.none_button.clicked.connect(lambda: self.model.set_mask(False))
+
+        self.count_label = QLabel(self)
+        self.model.selectionChanged.connect(self.update_count)
+        self.update_count()
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.all_button)
+        buttons.addWidget(self.none_button)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        layout.addWidget(self.range_text)
+        layout.addLayout(buttons)
+        layout.addWidget(self.view)
+        layout.addWidget(self.count_label)
+
+    def select_ranges(self):
+        try:
+            mask = parse_ranges(self.range_text.text(), len(self.model.mask))
+        except ValueError as e:
+            self.count_label.setText(str(e))
+            return
+        self.model.set_mask(mask)
+
+    def update_count(self):
+        self.count_label.setText('%d of %d selected' % (np.count_nonzero(self.model.mask),len(self.model.mask)))
+
+    def selected(self):
+        """Indices of the checked spectra"""
+        return self.model.selected()
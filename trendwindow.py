@@ -0,0 +1,185 @@
+import sys, os
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+
+import numpy as np
+import matplotlib
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.figure import Figure
+
+
+class TrendTable:
+    """Value and stderr of every parameter across an orbital's fit_results.
+
+    A FitResultStore already keeps these as arrays, so its columns are used as
+    they are. For a plain list of ModelResults all parameters are pulled out in
+    one pass and kept; after that only the indices marked stale by a refit are
+    read again.
+    """
+
+    def __init__(self, spectra_obj):
+        self.spectra_obj = spectra_obj
+        self.reset()
+
+    def reset(self):
+        self.param_names = list(self.spectra_obj.params.keys()) if hasattr(self.spectra_obj,'params') else []
+        self.values = None
+        self.stderr = None
+        self.fitted = None
+        self.stale = set()
+
+    def invalidate(self, i):
+        self.stale.add(i)
+
+    def extract(self, rows):
+        fit_results = self.spectra_obj.fit_results
+        for i in rows:
+            result = fit_results[i]
+            # Results from before a model change don't have this model's parameters
+            if (result == []) or any([name not in result.params for name in self.param_names]):
+                self.fitted[i] = False
+                continue
+            self.fitted[i] = True
+            self.values[i] = [result.params[name].value for name in self.param_names]
+            self.stderr[i] = [np.nan if result.params[name].stderr is None else result.params[name].stderr \
+                for name in self.param_names]
+
+    def column(self, name):
+        """(value, stderr, fitted) arrays of parameter name, one entry per spectrum.
+
+        None if the fit results are of another model than the loaded one, which
+        is the case after load_model until the next fit.
+        """
+        fit_results = self.spectra_obj.fit_results
+        if hasattr(fit_results,'tables'):
+            if name not in fit_results.param_names:
+                return None
+            return fit_results.values[name], fit_results.stderr[name], fit_results.is_fitted()
+
+        n = len(fit_results)
+        if (self.values is None) or (len(self.values) != n):
+            self.values = np.full((n,len(self.param_names)), np.nan)
+            self.stderr = np.full((n,len(self.param_names)), np.nan)
+            self.fitted = np.zeros(n, dtype = bool)
+            self.extract(range(n))
+        elif self.stale:
+            self.extract(sorted(self.stale))
+        self.stale = set()
+
+        k = self.param_names.index(name)
+        return self.values[:,k], self.stderr[:,k], self.fitted
+
+
+class TrendWindow(QMainWindow):
+    """Plot one fit parameter against spectrum index for every fitted spectrum.
+
+    Clicking a point emits spectrumPicked with its index.
+    """
+    spectrumPicked = pyqtSignal(int)
+
+    def __init__(self, parent = None, spectra_obj = None):
+        QMainWindow.__init__(self, parent)
+
+        self.setWindowTitle('Parameter Trends')
+        self.spectra_obj = spectra_obj
+        self.table = TrendTable(spectra_obj)
+        self.indices = np.array([], dtype = int)
+
+        # Fits finishing in quick succession only redraw once
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(100)
+        self.redraw_timer.timeout.connect(self.update_plot)
+
+        self.create_main_frame()
+        self.create_status_bar()
+        self.update_plot()
+
+    def spectrum_fitted(self, i):
+        self.table.invalidate(i)
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+
+    def model_changed(self):
+        """The model was reloaded, so the parameter names may have changed"""
+        self.table.reset()
+        self.param_box.blockSignals(True)
+        self.param_box.clear()
+        self.param_box.addItems(self.table.param_names)
+        self.param_box.blockSignals(False)
+        self.update_plot()
+
+    def on_pick(self, event):
+        if (event.artist is not self.points) or (len(event.ind) == 0):
+            return
+        i = int(self.indices[event.ind[0]])
+        self.statusBar().showMessage('Spectrum %d' % i, 2000)
+        self.spectrumPicked.emit(i)
+
+    def update_plot(self):
+        self.axes.clear()
+        self.points = None
+        name = self.param_box.currentText()
+        if (name == '') or (not hasattr(self.spectra_obj,'fit_results')):
+            self.canvas.draw()
+            return
+
+        column = self.table.column(name)
+        if column is None:
+            self.canvas.draw()
+            self.status_text.setText('No fits with this model yet')
+            return
+        value, stderr, fitted = column
+        self.indices = np.flatnonzero(fitted)
+        if self.errorbar_cb.isChecked():
+            self.axes.errorbar(self.indices, value[self.indices], yerr = stderr[self.indices], fmt = 'none', ecolor = 'gray')
+        self.points, = self.axes.plot(self.indices, value[self.indices], 'o', picker = 5)
+        self.axes.set_xlabel('Spectrum')
+        self.axes.set_ylabel(name)
+        self.axes.grid(self.grid_cb.isChecked())
+        self.canvas.draw()
+        self.status_text.setText('%d of %d spectra fit' % (len(self.indices),len(fitted)))
+
+    """Build the Main window"""
+    def create_main_frame(self):
+        self.main_frame = QWidget()
+
+        self.dpi = 100
+        self.fig = Figure((5.0, 4.0), dpi=self.dpi)
+        self.canvas = FigureCanvas(self.fig)
+        self.canvas.setParent(self.main_frame)
+        self.axes = self.fig.add_subplot(111)
+        self.canvas.mpl_connect('pick_event', self.on_pick)
+
+        self.mpl_toolbar = NavigationToolbar(self.canvas, self.main_frame)
+
+        self.param_box = QComboBox()
+        self.param_box.addItems(self.table.param_names)
+        self.param_box.currentIndexChanged.connect(self.update_plot)
+
+        self.errorbar_cb = QCheckBox("Error Bars")
+        self.errorbar_cb.setChecked(True)
+        self.errorbar_cb.stateChanged.connect(self.update_plot)
+
+        self.grid_cb = QCheckBox("Show &Grid")
+        self.grid_cb.setChecked(False)
+        self.grid_cb.stateChanged.connect(self.update_plot)
+
+        hbox = QHBoxLayout()
+        for w in [self.param_box, self.errorbar_cb, self.grid_cb]:
+            hbox.addWidget(w)
+            hbox.setAlignment(w, Qt.AlignVCenter)
+
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.canvas)
+        vbox.addWidget(self.mpl_toolbar)
+        vbox.addLayout(hbox)
+
+        self.main_frame.setLayout(vbox)
+        self.setCentralWidget(self.main_frame)
+
+    def create_status_bar(self):
+        self.status_text = QLabel("")
+        self.statusBar().addWidget(self.status_text, 1)
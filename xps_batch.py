@@ -0,0 +1,122 @@
+"""
+Headless batch processing of XPS samples, no Qt needed.
+
+Runs the same steps as the GUI: load the sample, background subtract with the
+saved bg_info, load a model per orbital, fit every spectrum and save the
+analysis back to the sample file.
+
+    python xps_batch.py sample.hdf5 -e surface_profile_1 -m Nb3d=Nb3d_oxides -m Si2p=Si2p_oxide -w 16
+    python xps_batch.py /path/to/sample_library -e surface_profile_1 -m Nb3d=Nb3d_oxides
+"""
+import sys, os
+import glob
+import argparse
+import time
+sys.path.append("/Users/cassberk/code")
+import XPyS.io
+import XPyS.models
+
+import bg_engine
+import fitting
+import sample_io
+
+
+def parse_models(model_args):
+    """['Nb3d=Nb3d_oxides', ...] -> {'Nb3d': 'Nb3d_oxides', ...}"""
+    models = {}
+    for arg in model_args:
+        if '=' not in arg:
+            raise argparse.ArgumentTypeError('Models are given as orbital=model_name, got %s' % arg)
+        orbital, model_name = arg.split('=',1)
+        models[orbital.strip()] = model_name.strip()
+    return models
+
+
+def sample_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path,'**','*.hdf5'), recursive = True))
+    return [path]
+
+
+def process_orbital(sample, orbital, model_name, workers = None, autofit = False, bg_sub = True, batch_bg = False):
+    spectra_obj = sample.__dict__[orbital]
+
+    if bg_sub:
+        subpars = list(sample.bg_info[orbital])
+        bg_engine.run_bg_sub(spectra_obj, subpars, batch = batch_bg)
+        sample.bg_info[orbital] = spectra_obj.bg_info
+
+    ldd_mod = XPyS.models.load_model(model_name)
+    spectra_obj.mod = ldd_mod[0]
+    spectra_obj.params = ldd_mod[1]
+    spectra_obj.pairlist = ldd_mod[2]
+    spectra_obj.element_ctrl = ldd_mod[3]
+
+    fit_results = fitting.empty_fit_results(spectra_obj)
+    failed = 0
+    for i, result in fitting.iter_fit_parallel(spectra_obj, range(len(spectra_obj.isub)), autofit = autofit, max_workers = workers):
+        if isinstance(result, Exception):
+            print('    spectrum',i,'failed:',result)
+            failed += 1
+        else:
+            fit_results[i] = result
+    return failed
+
+
+def process_sample(filepath, experiment_name, models, workers = None, autofit = False, bg_sub = True, batch_bg = False, \
+    save = True):
+    print('Loading',filepath,experiment_name)
+    sample = XPyS.io.load_sample(filepath = filepath, experiment_name = experiment_name)
+    failed = 0
+    for orbital, model_name in models.items():
+        if orbital not in sample.element_scans:
+            print('  ',orbital,'not in sample, skipping')
+            continue
+        t0 = time.time()
+        n_failed = process_orbital(sample, orbital, model_name, workers = workers, autofit = autofit, bg_sub = bg_sub, \
+            batch_bg = batch_bg)
+        print('  ',orbital,'fit with',model_name,'in %.1f s,' % (time.time()-t0),n_failed,'failed')
+        failed += n_failed
+        if save:
+            XPyS.io.save_spectra_analysis(sample.__dict__[orbital],filepath = filepath, experiment_name = experiment_name,force = True)
+            sample_io.forget_saved_analysis(filepath, experiment_name, [orbital])
+    return failed
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Background subtract, fit and save XPS samples without the GUI')
+    parser.add_argument('path', help = 'sample .hdf5 file or a directory of them')
+    parser.add_argument('-e','--experiment', required = True, help = 'experiment name inside the sample file')
+    parser.add_argument('-m','--model', action = 'append', default = [], metavar = 'ORBITAL=MODEL', \
+        help = 'model to fit an orbital with, can be given more than once')
+    parser.add_argument('-w','--workers', type = int, default = None, help = 'fit processes (default: all cores)')
+    parser.add_argument('--autofit', action = 'store_true', help = 'seed every spectrum with autofit guesses')
+    parser.add_argument('--no-bg-sub', action = 'store_true', help = 'fit the existing background subtraction')
+    parser.add_argument('--batch-bg', action = 'store_true', \
+        help = 'numpy batch backgrounds instead of XPyS bg_sub (check them with check_backgrounds.py first)')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'process but do not save')
+    args = parser.parse_args(argv)
+
+    models = parse_models(args.model)
+    if models == {}:
+        parser.error('at least one --model ORBITAL=MODEL is needed')
+
+    failed_samples = []
+    for filepath in sample_files(args.path):
+        try:
+            process_sample(filepath, args.experiment, models, workers = args.workers, autofit = args.autofit, \
+                bg_sub = not args.no_bg_sub, batch_bg = args.batch_bg, save = not args.dry_run)
+        except Exception as e:
+            print('Failed on',filepath,':',e)
+            failed_samples.append(filepath)
+
+    if failed_samples != []:
+        print(len(failed_samples),'samples failed:')
+        for filepath in failed_samples:
+            print('  ',filepath)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,42 +4,48 @@ This is an application for fitting xps spectra using the XPyS package.
 Created by: Cassidy Berk, Cassidy.Berk@gmail.com
 """
 import sys, os, random
+import time
+_t_start = time.perf_counter()
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-import h5py
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.figure import Figure
-import lmfit as lm
+import lazy_import
+from lazy_import import lazy, lazy_attr
+lazy_import.record('PyQt5', time.perf_counter() - _t_start)
+
+"""Everything below is only imported the first time it is used, so the sample
+window shows before numpy, h5py, matplotlib, lmfit and XPyS have loaded"""
+np = lazy('numpy')
+h5py = lazy('h5py')
+lm = lazy('lmfit')
 import pickle
-import os
 sys.path.append("/Users/cassberk/code")
-import XPyS.io
-import XPyS.sample
+XPyS = lazy('XPyS')
 
-import XPyS.saved_models.Nb3d.nb_oxide_analysis as nbox
-import XPyS.saved_models.Si2p.si_oxide_analysis as siox
+nbox = lazy('XPyS.saved_models.Nb3d.nb_oxide_analysis')
+siox = lazy('XPyS.saved_models.Si2p.si_oxide_analysis')
 
 from copy import deepcopy as dc
 
-from parameter_gui import ParameterWindow
-from fitwindow import FitViewWindow
-from OverviewWindow import OverviewWindow
-from bgSubWindow import bgSubWindow
-import data_tree
+ParameterWindow = lazy_attr('parameter_gui','ParameterWindow')
+FitViewWindow = lazy_attr('fitwindow','FitViewWindow')
+OverviewWindow = lazy_attr('OverviewWindow','OverviewWindow')
+bgSubWindow = lazy_attr('bgSubWindow','bgSubWindow')
+data_tree = lazy('data_tree')
+sample_io = lazy('sample_io')
+experiment_index = lazy('experiment_index')
 
-from IPython import embed as shell
+IPython = lazy('IPython')
+import changes
 
 
 class ExpChooseWindow(QWidget):
 
-    def __init__(self,files):
+    def __init__(self,files,details = None):
         super().__init__()
         self.files = files
+        self.details = details if details is not None else {}
         self.initUI()
 
     def initUI(self):
@@ -50,6 +56,9 @@ class ExpChooseWindow(QWidget):
         self.listWidget = QListWidget(self)
 
         self.listWidget.addItems([file for file in self.files])
+        for k, file in enumerate(self.files):
+            if file in self.details:
+                self.listWidget.item(k).setToolTip(self.details[file])
 
         self.ExperimentSelectButton = QPushButton('Select', self)
         # self.ExperimentSelectButton.clicked.connect(self.onClearClicked)
@@ -75,14 +84,87 @@ class ExpChooseWindow(QWidget):
     #         f'# of birds {self.listWidget.count()}')
 
 
+class SaveWorker(QObject):
+    """Writes the sample off the GUI thread.
+
+    With orbitals given only those spectra are saved, each with
+    XPyS.io.save_spectra_analysis, otherwise the whole sample with
+    XPyS.io.save_sample. With incremental, sample_io rewrites only what
+    changed instead, in a layout only this GUI reads back (fit tables, lmfit
+    attributes), not XPyS.io.
+    """
+    progress = pyqtSignal(int, int, str)
+    failed = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, sample, orbitals = None, incremental = False):
+        super().__init__()
+        self.sample = sample
+        self.orbitals = orbitals
+        self.incremental = incremental
+
+    def save_spectra(self):
+        for n, orbital in enumerate(self.orbitals):
+            spectra_obj = self.sample.__dict__[orbital]
+            # Taken first so anything changed during the save is saved next time
+            saved = changes.content(spectra_obj)
+            dirty = changes.take_dirty(spectra_obj)
+            bg_info_dirty = changes.take_index(self.sample, 'bg_info', orbital)
+            try:
+                with sample_io.reads_held():
+                    XPyS.io.save_spectra_analysis(spectra_obj,filepath = self.sample.load_path, experiment_name = self.sample.experiment_name,force = True)
+                sample_io.forget_saved_analysis(self.sample.load_path, self.sample.experiment_name, [orbital])
+            except Exception:
+                changes.restore_dirty(spectra_obj, dirty)
+                if bg_info_dirty:
+                    changes.mark_dirty(self.sample, 'bg_info', orbital)
+                raise
+            changes.mark_saved(spectra_obj, saved)
+            self.progress.emit(n+1, len(self.orbitals), orbital)
+
+    def save_sample(self):
+        # Changes are taken first so anything marked during the save is kept for the next one
+        saved = [(self.sample.__dict__[orb], changes.content(self.sample.__dict__[orb])) for orb in self.sample.element_scans]
+        taken = changes.take_sample_dirty(self.sample)
+        try:
+            with sample_io.reads_held():
+                XPyS.io.save_sample(self.sample,filepath = self.sample.load_path, experiment_name = self.sample.experiment_name,force = True)
+            sample_io.forget_saved_analysis(self.sample.load_path, self.sample.experiment_name)
+        except Exception:
+            changes.restore_all(taken)
+            raise
+        for spectra_obj, content in saved:
+            changes.mark_saved(spectra_obj, content)
+
+    def run(self):
+        try:
+            if (self.orbitals is not None) and self.incremental:
+                sample_io.save_spectra_batch(self.sample, self.orbitals, progress = self.progress.emit)
+            elif self.orbitals is not None:
+                self.save_spectra()
+            elif self.incremental and not changes.is_dirty(self.sample, 'overview'):
+                sample_io.save_sample_incremental(self.sample, progress = self.progress.emit)
+            else:
+                # The overview results aren't tracked piece by piece, XPyS writes them with everything else
+                self.save_sample()
+        except Exception as e:
+            self.failed.emit(str(e))
+        self.finished.emit()
+
+
 class SampleHandler(QWidget):
     def __init__(self,treeparent = None, treechildren = None):
         QWidget.__init__(self)
         
         self.SpectraWindows = {}
         self.OverviewWindow = {}
+        self.save_thread = None
         self.show_sampletree_window()
 
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setInterval(60*1000)
+        self.autosave_timer.timeout.connect(self.autosave)
+
 
 
     def show_sampletree_window(self,treeparent = None, treechildren = None):
@@ -102,6 +184,13 @@ class SampleHandler(QWidget):
         self.LoadRecentButton = QPushButton('Load Recent Sample', self)
         self.LoadRecentButton.clicked.connect(self.loadRecent)
 
+        self.lazy_load_cb = QCheckBox("Lazy Load")
+        self.lazy_load_cb.setChecked(False)
+        self.lazy_load_cb.setToolTip('Only read an orbital\'s spectra from the file when they are used,\n'
+            'raw spectra stored uncompressed are memory mapped instead of read.\n'
+            'Backgrounds can only be subtracted with Batch backgrounds checked, samples\n'
+            'analysed and saved through XPyS are loaded in full')
+
         self.button = QPushButton('Print', self)
         self.button.clicked.connect(self.vrfs_selected)
 
@@ -149,14 +238,33 @@ class SampleHandler(QWidget):
         overviewHbox.addWidget(self.plot_atp_cb)
         overviewHbox.addWidget(self.overview_plot_button)
 
+        self.save_progress = QProgressBar(self)
+        self.save_progress.setFormat('Saved %v/%m')
+        self.save_progress.hide()
+
+        self.autosave_cb = QCheckBox("Autosave")
+        self.autosave_cb.setChecked(False)
+        self.autosave_cb.setToolTip('Save what changed once a minute')
+        self.autosave_cb.toggled.connect(self.toggle_autosave)
+
+        self.incremental_save_cb = QCheckBox("Incremental Save")
+        self.incremental_save_cb.setChecked(False)
+        self.incremental_save_cb.setToolTip('Only rewrite the datasets that changed. Fits are saved as tables that\n'
+            'this GUI reads back but XPyS.io does not, leave unchecked for files\n'
+            'others open with XPyS')
+
         SaveLayout = QHBoxLayout()
         SaveLayout.addWidget(self.saveSampleButton)
         SaveLayout.addWidget(self.saveSpectraButton)
+        SaveLayout.addWidget(self.autosave_cb)
+        SaveLayout.addWidget(self.incremental_save_cb)
+        SaveLayout.addWidget(self.save_progress)
 
         layout = QVBoxLayout(self)
         layout.addWidget(self.tree)
         layout.addWidget(self.addSampleButton)
         layout.addWidget(self.LoadRecentButton)
+        layout.addWidget(self.lazy_load_cb)
         layout.addLayout(overviewHbox)
         layout.addWidget(self.overview_button)
         layout.addWidget(self.fitwindowbutton)
@@ -174,11 +282,13 @@ class SampleHandler(QWidget):
         _files,_ = file_name.getOpenFileNames(self, ".hdf5", "/Volumes/GoogleDrive/Shared drives/StOQD/sample_library", filter)
         # shell()
         if not _files == []:
-            with h5py.File(_files[0],'r+') as f:
-                self.experiments = [grp for grp in f.keys()]
+            # Listed from the experiment index, the file is at most opened read only
+            index = experiment_index.default_index()
+            self.experiments = index.experiments(_files[0])
             print(self.experiments)
             # if len([grp for grp in self.experiments]) > 1:
-            self.expchooseWindow = ExpChooseWindow(self.experiments)
+            self.expchooseWindow = ExpChooseWindow(self.experiments, \
+                details = {exp: index.describe(_files[0], exp) for exp in self.experiments})
             self.expchooseWindow.ExperimentSelectButton.clicked.connect(lambda: self.choose_experiment(_files[0]))
             self.expchooseWindow.show()
         # else:
@@ -192,13 +302,74 @@ class SampleHandler(QWidget):
             self.savehdf5_sample()
 
     def saveSpectra(self):
+        """Save the checked spectra that changed since they were loaded or saved, in the background.
+
+        What changed is judged by content (changes.changed), so parameter edits
+        that mark nothing are saved too.
+        """
+        if self.save_thread is not None:
+            print('Still saving')
+            return
         self.vrfs_selected()
-        print(self.updatelist)
-            # print(fileName)
-        for spec in self.updatelist:
-            # print(spec,'will be saved to', self.sample.load_path)
-            XPyS.io.save_spectra_analysis(self.sample.__dict__[spec],filepath = self.sample.load_path, experiment_name = self.sample.experiment_name,force = True)
-            # print(self.sample.experiment_name)
+        if self.updatelist == []:
+            print('No spectra checked to save')
+            return
+        orbitals = [spec for spec in self.updatelist if changes.changed(self.sample.__dict__[spec])]
+        if orbitals == []:
+            print('Nothing changed since the last save')
+            return
+        self.start_save(orbitals, len(orbitals))
+
+    def start_save(self, orbitals = None, n = 1):
+        self.saveSpectraButton.setEnabled(False)
+        self.saveSampleButton.setEnabled(False)
+        self.save_progress.setRange(0,n)
+        self.save_progress.setValue(0)
+        self.save_progress.show()
+
+        self.save_worker = SaveWorker(self.sample, orbitals, incremental = self.incremental_save_cb.isChecked())
+        self.save_thread = QThread(self)
+        self.save_worker.moveToThread(self.save_thread)
+        self.save_thread.started.connect(self.save_worker.run)
+        self.save_worker.progress.connect(self.update_save_progress)
+        self.save_worker.failed.connect(self.save_failed)
+        self.save_worker.finished.connect(self.save_thread.quit)
+        self.save_thread.finished.connect(self.save_finished)
+        self.save_thread.start()
+
+    def update_save_progress(self, n, total, orbital):
+        self.save_progress.setMaximum(total)
+        self.save_progress.setValue(n)
+        print(orbital,'saved to',self.save_worker.sample.load_path)
+
+    def save_failed(self, message):
+        print('Save failed:',message)
+
+    def save_finished(self):
+        self.save_thread.deleteLater()
+        self.save_worker.deleteLater()
+        self.save_thread = None
+        self.save_worker = None
+        self.save_progress.hide()
+        self.saveSpectraButton.setEnabled(True)
+        self.saveSampleButton.setEnabled(True)
+
+    def toggle_autosave(self, checked):
+        if checked:
+            self.autosave_timer.start()
+        else:
+            self.autosave_timer.stop()
+
+    def autosave(self):
+        """Only touches the file when something changed. Without Incremental Save only the
+        changed orbitals are written through XPyS.io, unless the overview needs saving."""
+        if (not hasattr(self,'sample')) or (self.save_thread is not None):
+            return
+        orbitals = changes.dirty_orbitals(self.sample)
+        if changes.is_dirty(self.sample, 'overview') or (self.incremental_save_cb.isChecked() and (orbitals != [])):
+            self.savehdf5_sample()
+        elif orbitals != []:
+            self.start_save(orbitals, len(orbitals))
 
     def build_sample_tree(self):
         self.treeparent = self.sample.sample_name
@@ -213,13 +384,36 @@ class SampleHandler(QWidget):
         self.expchooseWindow.close()   
 
     def loadhdf5_sample(self,filepath,experiment_name):
-        self.sample = XPyS.io.load_sample(filepath = filepath, experiment_name = experiment_name)
+        sample = None
+        if self.lazy_load_cb.isChecked():
+            # Only group metadata is read here, spectra come off disk when they are used
+            sample = sample_io.LazySample(filepath = filepath, experiment_name = experiment_name)
+            if sample.xpys_analysed() != []:
+                print(', '.join(sample.xpys_analysed()),'were analysed and saved through XPyS, '
+                    'which only a full load reads back. Loading without Lazy Load.')
+                sample.close()
+                sample = None
+        if sample is not None:
+            self.sample = sample
+        else:
+            self.sample = XPyS.io.load_sample(filepath = filepath, experiment_name = experiment_name)
+            # Fits and models saved by sample_io aren't read by XPyS.io
+            sample_io.load_saved_analysis(self.sample)
+            # Freshly loaded means nothing to save yet
+            changes.mark_sample_clean(self.sample)
         self.build_sample_tree()
         with open('recentfile.txt','w') as f:
             f.write(filepath+','+experiment_name)
     
     def savehdf5_sample(self):
-        XPyS.io.save_sample(self.sample,filepath = self.sample.load_path, experiment_name = self.sample.experiment_name,force = True)
+        """Save the sample in the background, if anything changed since it was loaded or saved"""
+        if self.save_thread is not None:
+            print('Still saving')
+            return
+        if not (changes.is_dirty(self.sample, 'overview') or changes.dirty_orbitals(self.sample)):
+            print('Nothing changed since the last save')
+            return
+        self.start_save()
 
     def loadRecent(self):
         with open('recentfile.txt') as f:
@@ -248,6 +442,10 @@ class SampleHandler(QWidget):
         self.iter +=1
 
     def clear_sample(self):
+        if self.save_thread is not None:
+            self.save_thread.wait()
+        if hasattr(self.sample,'close'):
+            self.sample.close()
         del self.sample
         self.tree.clear()
         self.iter=0
@@ -288,9 +486,24 @@ class SampleHandler(QWidget):
     def plot_overview(self):
 
         sender = self.sender()
+        if not hasattr(self.sample,'xps_overview'):
+            print('Overview needs the full sample, reload it without Lazy Load')
+            return
 
         if (sender.objectName() == 'overview_analysis') or (sender.objectName() == 'setBGbutton'):
             self.sample.xps_overview(plotflag = False)
+            changes.mark_dirty(self.sample, 'overview')
+        self.show_overview_plots()
+
+    def refresh_overview(self):
+        """Rerun xps_overview once after a batch background subtraction"""
+        if not hasattr(self.sample,'xps_overview'):
+            return
+        self.sample.xps_overview(plotflag = False)
+        changes.mark_dirty(self.sample, 'overview')
+        self.show_overview_plots()
+
+    def show_overview_plots(self):
         for cb in [self.plot_all_cb,self.plot_bg_cb,self.plot_atp_cb]:
             if cb.isChecked():
                 overview_type = cb.objectName()
@@ -302,10 +515,11 @@ class SampleHandler(QWidget):
     def bgsub(self):
         self.bgSubWin = bgSubWindow(sample = self.sample)
         self.bgSubWin.setBG_Button.clicked.connect(self.plot_overview)
+        self.bgSubWin.allSubtracted.connect(self.refresh_overview)
         self.bgSubWin.show()
 
     def shelldebug(self):
-        shell()
+        IPython.embed()
 
 
     ### Linking Parameter amplitudes
@@ -419,6 +633,10 @@ def main():
     # form = FitViewWindow()
     form = SampleHandler()
     form.show()
+    if '--import-times' in sys.argv:
+        # Report once the window is up, later imports are printed as they happen
+        lazy_import.verbose = True
+        QTimer.singleShot(0, lambda: lazy_import.report(startup = time.perf_counter() - _t_start))
     app.exec_()
 
 